@@ -0,0 +1,227 @@
+"""
+任务变更日志（write-behind）。
+
+请求线程只把事件放入进程内有界队列，后台线程按条数或时间间隔批量写入 task_events
+（多行 INSERT），不在请求路径上增加写库开销。队列满时按 ACTIVITY_OVERFLOW 处理：
+drop 直接丢弃并计数；block 最多等待 ACTIVITY_BLOCK_TIMEOUT 秒（背压），仍满则丢弃。
+停止时会把队列中剩余事件全部写完。计数（入队、写入、丢弃、背压、重试等）每
+ACTIVITY_STATS_LOG_SECONDS 秒写一次日志，有丢弃或写入失败时为 WARNING。
+
+批量写入失败时按 ACTIVITY_RETRY_BACKOFF 指数退避重试，最多 ACTIVITY_RETRY_ATTEMPTS 次
+（期间新事件在队列中缓冲），短暂的数据库故障不会丢失变更记录。
+
+事件丢弃或重试后仍写入失败时，涉及的用户记为待修复，写入线程在下一次写入后按用户重算
+按天统计（rollups.rebuild）；列计数在任务写入的事务里维护，不受影响。进程崩溃丢失的
+队列仍需执行 python rollups.py --rebuild。
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable, List, Optional, Set
+
+from sqlalchemy import insert
+
+import models
+import rollups
+from models import TaskEvent, utcnow
+
+ACTIVITY_QUEUE_SIZE = int(os.getenv("ACTIVITY_QUEUE_SIZE", "10000"))
+ACTIVITY_FLUSH_SIZE = int(os.getenv("ACTIVITY_FLUSH_SIZE", "500"))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "1.0"))
+ACTIVITY_OVERFLOW = os.getenv("ACTIVITY_OVERFLOW", "drop")  # drop / block
+ACTIVITY_BLOCK_TIMEOUT = float(os.getenv("ACTIVITY_BLOCK_TIMEOUT", "0.05"))
+ACTIVITY_RETRY_ATTEMPTS = int(os.getenv("ACTIVITY_RETRY_ATTEMPTS", "5"))
+ACTIVITY_RETRY_BACKOFF = float(os.getenv("ACTIVITY_RETRY_BACKOFF", "0.5"))
+ACTIVITY_STATS_LOG_SECONDS = float(os.getenv("ACTIVITY_STATS_LOG_SECONDS", "60"))
+
+logger = logging.getLogger("activity")
+
+_STOP = object()
+
+
+class ActivityLog:
+    def __init__(
+        self,
+        maxsize: int = ACTIVITY_QUEUE_SIZE,
+        flush_size: int = ACTIVITY_FLUSH_SIZE,
+        flush_interval: float = ACTIVITY_FLUSH_INTERVAL,
+        overflow: str = ACTIVITY_OVERFLOW,
+        block_timeout: float = ACTIVITY_BLOCK_TIMEOUT,
+        retry_attempts: int = ACTIVITY_RETRY_ATTEMPTS,
+        retry_backoff: float = ACTIVITY_RETRY_BACKOFF,
+        stats_log_seconds: float = ACTIVITY_STATS_LOG_SECONDS,
+    ):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.stats_log_seconds = stats_log_seconds
+        self._queue: "queue.Queue" = queue.Queue(maxsize=maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {
+            "enqueued": 0,
+            "written": 0,
+            "dropped": 0,
+            "blocked": 0,
+            "flushes": 0,
+            "retries": 0,
+            "write_errors": 0,
+            "repairs": 0,
+        }
+        # 计数在请求线程与写入线程中并发累加
+        self._stats_lock = threading.Lock()
+        # 事件丢失、按天统计需要重算的用户
+        self._dirty: Set[int] = set()
+        self._dirty_lock = threading.Lock()
+        # 上次写日志时的 (dropped, write_errors)，有新增时以 WARNING 输出
+        self._logged_losses = (0, 0)
+
+    def record(self, user_id: int, task_id: int, event_type: str, stage: Optional[str] = None,
+               completed: Optional[bool] = None, version: Optional[int] = None) -> None:
+        event = {
+            "user_id": user_id,
+            "task_id": task_id,
+            "event_type": event_type,
+            "stage": stage,
+            "completed": completed,
+            "version": version,
+            "occurred_at": utcnow(),
+            "stage_since": None,
+        }
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            if self.overflow != "block":
+                self._count("dropped")
+                self.mark_dirty([user_id])
+                return
+            self._count("blocked")
+            try:
+                self._queue.put(event, timeout=self.block_timeout)
+            except queue.Full:
+                self._count("dropped")
+                self.mark_dirty([user_id])
+                return
+        self._count("enqueued")
+
+    def record_task(self, event_type: str, t) -> None:
+        self.record(t.user_id, t.id, event_type, t.column_name, bool(t.completed), t.version)
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self.stats[name] += n
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return dict(stats, queued=self._queue.qsize())
+
+    def flush(self, events: List[dict]) -> None:
+        if not events:
+            return
+        by_engine = defaultdict(list)
+        for e in events:
+            by_engine[models.engine_for_user(e["user_id"])].append(e)
+        for bind, rows in by_engine.items():
+            if self._write(bind, rows):
+                self._count("written", len(rows))
+            else:
+                self._count("write_errors", len(rows))
+                self.mark_dirty(e["user_id"] for e in rows)
+        self._count("flushes")
+
+    def _write(self, bind, rows: List[dict]) -> bool:
+        delay = self.retry_backoff
+        for attempt in range(1, self.retry_attempts + 1):
+            try:
+                with bind.begin() as conn:
+                    # 同一事务内更新看板统计汇总
+                    rollups.apply_events(conn, rows)
+                    conn.execute(insert(TaskEvent), rows)
+                return True
+            except Exception:
+                if attempt == self.retry_attempts:
+                    logger.exception("failed to write %d task events after %d attempts", len(rows), attempt)
+                    return False
+                logger.warning("failed to write %d task events, retrying in %.1fs", len(rows), delay, exc_info=True)
+                self._count("retries")
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def mark_dirty(self, user_ids: Iterable[int]) -> None:
+        with self._dirty_lock:
+            self._dirty.update(user_ids)
+
+    def repair(self) -> None:
+        """按用户重算按天统计；失败的用户留待下次。只在写入线程（或停止后）调用，
+        保证重算时没有已出队未写入的事件。"""
+        with self._dirty_lock:
+            users, self._dirty = self._dirty, set()
+        if not users:
+            return
+        by_engine = defaultdict(list)
+        for uid in users:
+            by_engine[models.engine_for_user(uid)].append(uid)
+        for bind, uids in by_engine.items():
+            try:
+                rollups.rebuild(bind, uids, stages=False)
+                self._count("repairs", len(uids))
+            except Exception:
+                self.mark_dirty(uids)
+                logger.exception("failed to rebuild daily stats for %d users", len(uids))
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="activity-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        # 停止标记排在队尾，保证之前的事件全部落库
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self.log_stats()
+
+    def log_stats(self) -> None:
+        stats = self.snapshot()
+        lost = (stats["dropped"], stats["write_errors"])
+        level = logging.WARNING if lost != self._logged_losses else logging.INFO
+        self._logged_losses = lost
+        logger.log(level, "activity log stats: %s", stats)
+
+    def _run(self) -> None:
+        batch: List[dict] = []
+        deadline = time.monotonic() + self.flush_interval
+        next_log = time.monotonic() + self.stats_log_seconds
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self.flush(batch)
+                self.repair()
+                return
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.flush_size or time.monotonic() >= deadline:
+                self.flush(batch)
+                batch = []
+                self.repair()
+                deadline = time.monotonic() + self.flush_interval
+                if time.monotonic() >= next_log:
+                    self.log_stats()
+                    next_log = time.monotonic() + self.stats_log_seconds
+
+
+activity_log = ActivityLog()
@@ -0,0 +1,136 @@
+"""
+冷热分离：把已完成且超过指定天数未更新的任务迁入 tasks_archive。
+
+按主键分批（INSERT ... SELECT + DELETE，每批一个事务），批间暂停以限制对线上库的压力。
+候选行在事务内加锁（FOR UPDATE SKIP LOCKED），迁移与删除重复归档条件，汇总按实际迁移的行扣减。
+
+用法：
+    python archive.py --days 90 --batch 500 --pause 0.1
+也可设置 ARCHIVE_INTERVAL_SECONDS，由 main.py 在进程内周期运行。
+"""
+import argparse
+import logging
+import os
+import threading
+from datetime import timedelta
+from typing import List, Optional
+
+from sqlalchemy import delete, insert, literal, select
+
+import models
+import rollups
+from models import Task, TaskArchive, utcnow
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_PAUSE_SECONDS = float(os.getenv("ARCHIVE_PAUSE_SECONDS", "0.1"))
+# 0 表示不在服务进程内运行后台归档
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "0"))
+
+logger = logging.getLogger("archive")
+
+_ARCHIVE_COLUMNS = [c.name for c in Task.__table__.columns]
+
+
+def _archivable(table, cutoff):
+    return (table.c.completed == True) & (table.c.updated_at < cutoff)  # noqa: E712
+
+
+def _lock_candidates(conn, cutoff, batch_size: int) -> List[int]:
+    # MySQL 下锁住本批行（已被其他归档进程锁住的跳过），提交前切换/移动会等待；SQLite 忽略 FOR UPDATE
+    return list(conn.execute(
+        select(Task.id)
+        .where(_archivable(Task.__table__, cutoff))
+        .order_by(Task.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars())
+
+
+def archive_batch(bind, cutoff, batch_size: int) -> int:
+    tasks = Task.__table__
+    archived = TaskArchive.__table__
+    with bind.begin() as conn:
+        ids = _lock_candidates(conn, cutoff, batch_size)
+        if not ids:
+            return 0
+        # 迁移与删除都重新带上归档条件：候选查询之后被取消完成的任务留在原表
+        source = select(*[tasks.c[name] for name in _ARCHIVE_COLUMNS], literal(utcnow())).where(
+            tasks.c.id.in_(ids), _archivable(tasks, cutoff)
+        )
+        conn.execute(insert(archived).from_select(_ARCHIVE_COLUMNS + ["archived_at"], source))
+        # 汇总按实际迁入归档表的行（及其当时所在列）扣减
+        moved = conn.execute(
+            select(archived.c.id, archived.c.user_id, archived.c.stage).where(archived.c.id.in_(ids))
+        ).all()
+        if moved:
+            conn.execute(delete(tasks).where(tasks.c.id.in_([r.id for r in moved]), _archivable(tasks, cutoff)))
+            rollups.remove_tasks(conn, [(r.user_id, r.stage) for r in moved])
+    return len(moved)
+
+
+def archive_completed_tasks(
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    pause: float = ARCHIVE_PAUSE_SECONDS,
+    stop: Optional[threading.Event] = None,
+) -> int:
+    stop = stop or threading.Event()
+    cutoff = utcnow() - timedelta(days=older_than_days)
+    total = 0
+    for bind in [models.engine, *models.shard_engines]:
+        while not stop.is_set():
+            moved = archive_batch(bind, cutoff, batch_size)
+            total += moved
+            if moved < batch_size:
+                break
+            stop.wait(pause)
+    return total
+
+
+class ArchiveWorker:
+    def __init__(self, interval: int = ARCHIVE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="task-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                moved = archive_completed_tasks(stop=self._stop)
+                if moved:
+                    logger.info("archived %d completed tasks", moved)
+            except Exception:
+                logger.exception("task archival failed")
+
+
+archive_worker = ArchiveWorker()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old completed tasks")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=ARCHIVE_PAUSE_SECONDS)
+    args = parser.parse_args()
+
+    models.init_db()
+    moved = archive_completed_tasks(args.days, args.batch, args.pause)
+    print(f"archived {moved} tasks older than {args.days} days")
+
+
+if __name__ == "__main__":
+    main()
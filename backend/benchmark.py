@@ -0,0 +1,442 @@
+"""
+本地性能基准（默认使用临时 SQLite 库，无需 MySQL）。
+
+用法：
+    python benchmark.py jwt --tokens 500 --requests 200000
+    python benchmark.py shards --shards 1,2,4 --threads 8 --writes 4000
+    python benchmark.py sweep --keys 1000000
+    python benchmark.py compress --tasks 20,200,2000
+    python benchmark.py workers --workers 1,2,4 --clients 8 --seconds 10
+    python benchmark.py startup --runs 5 --max-ms 1500
+    python benchmark.py statements --calls 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='kanban-bench-')}/bench.db")
+
+
+def _rate(n: int, seconds: float) -> str:
+    return f"{n / seconds:>12,.0f} ops/s"
+
+
+# ---------- JWT 解码 ----------
+
+def bench_jwt(args):
+    from routers import auth
+
+    # 真实场景：一批活跃用户各持有一个 access token，在有效期内反复使用
+    backends = []
+    for name, factory in auth.JWT_BACKENDS.items():
+        try:
+            backends.append((name, factory()))
+        except ImportError:
+            print(f"skip {name}: not installed")
+
+    encode = backends[0][1][0]
+    now = int(time.time())
+    tokens = [
+        encode({"sub": str(i), "type": "access", "iat": now, "exp": now + 3600})
+        for i in range(args.tokens)
+    ]
+    rng = random.Random(42)
+    sequence = [rng.choice(tokens) for _ in range(args.requests)]
+
+    print(f"tokens={args.tokens} requests={args.requests}")
+    for name, (_, decode) in backends:
+        start = time.perf_counter()
+        for tok in sequence:
+            decode(tok)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<8} uncached {_rate(len(sequence), elapsed)}")
+
+        cache = auth.TokenCache(maxsize=args.cache_size)
+        start = time.perf_counter()
+        for tok in sequence:
+            claims = cache.get(tok)
+            if claims is None:
+                cache.put(tok, decode(tok))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<8} cached   {_rate(len(sequence), elapsed)}")
+
+
+# ---------- 分片写入吞吐 ----------
+
+def bench_shards(args):
+    import threading
+
+    import models
+
+    base = tempfile.mkdtemp(prefix="kanban-shards-")
+    per_thread = args.writes // args.threads
+    print(f"threads={args.threads} writes={per_thread * args.threads}")
+    for n in [int(x) for x in args.shards.split(",")]:
+        models.shard_engines = [models.make_engine(f"sqlite:///{base}/n{n}_shard{i}.db") for i in range(n)]
+        models.init_db()
+
+        def worker(offset: int):
+            for i in range(per_thread):
+                user_id = offset + i * args.threads + 1
+                with models.SessionLocal() as db:
+                    models.bind_user(db, user_id)
+                    db.add(models.Task(user_id=user_id, title=f"bench {i}"))
+                    db.commit()
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        print(f"shards={n:<3} {_rate(per_thread * args.threads, elapsed)}")
+        for e in models.shard_engines:
+            e.dispose()
+
+
+# ---------- 许可过期清扫 ----------
+
+def bench_sweep(args):
+    from datetime import timedelta
+
+    from sqlalchemy import insert
+
+    import entitlements
+    import models
+
+    models.init_db()
+    now = models.utcnow()
+    rng = random.Random(7)
+    # 约 1/10 的密钥已被使用并关联用户，到期时间分布在过去一年到未来一年
+    keys, users, links, states = [], [], [], []
+    user_id = 0
+    for i in range(1, args.keys + 1):
+        expires_at = now + timedelta(minutes=rng.randint(-525_600, 525_600))
+        used = i % 10 == 0
+        keys.append({"id": i, "key_hash": f"{i:064x}", "is_used": used, "is_multi_use": False,
+                     "feature": "pro", "expires_at": expires_at})
+        if used:
+            user_id += 1
+            users.append({"id": user_id, "username": f"u{user_id}", "email": f"u{user_id}@example.com",
+                          "password_hash": "x", "status": 1})
+            links.append({"user_id": user_id, "license_key_id": i, "feature": "pro"})
+            states.append({"user_id": user_id, "licensed": True, "feature": "pro", "valid_until": expires_at})
+
+    start = time.perf_counter()
+    with models.engine.begin() as conn:
+        for table, rows in ((models.User, users), (models.LicenseKey, keys),
+                            (models.UserLicense, links), (models.EntitlementState, states)):
+            for i in range(0, len(rows), 50_000):
+                conn.execute(insert(table), rows[i:i + 50_000])
+    print(f"loaded {len(keys):,} keys / {len(states):,} entitlements in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    revoked = entitlements.sweep_expired(batch_size=args.batch)
+    print(f"full sweep:        {time.perf_counter() - start:8.3f}s  revoked={revoked:,}")
+
+    # 增量清扫：只扫描上次清扫之后到期的密钥（模拟定时器 1 小时后醒来）
+    later = now + timedelta(hours=1)
+    start = time.perf_counter()
+    revoked = entitlements.sweep_expired(since=now, now=later, batch_size=args.batch)
+    print(f"incremental sweep: {time.perf_counter() - start:8.3f}s  revoked={revoked:,}")
+
+    start = time.perf_counter()
+    nxt = entitlements.next_expiry(after=later)
+    print(f"next expiry:       {time.perf_counter() - start:8.3f}s  at={nxt}")
+
+
+# ---------- 响应压缩 ----------
+
+def bench_compress(args):
+    import json
+
+    import compression
+    from models import Task, utcnow
+    from routers.tasks import ok, task_to_dict
+
+    rng = random.Random(42)
+    words = "fix review deploy board column api login license task sprint bug note".split()
+    now = utcnow()
+    print(f"encodings: {', '.join(compression.available_encodings()) or 'none'}")
+    for n in [int(x) for x in args.tasks.split(",")]:
+        tasks = [
+            Task(
+                id=i, user_id=1, title=" ".join(rng.choices(words, k=4)),
+                description=" ".join(rng.choices(words, k=rng.randint(0, args.words))),
+                column_name=rng.choice(["To Do", "Doing", "Done"]), completed=False,
+                created_at=now, updated_at=now, version=1,
+            )
+            for i in range(n)
+        ]
+        payload = json.dumps(ok(data=[task_to_dict(t) for t in tasks], count=n), separators=(",", ":")).encode()
+        print(f"\ntasks={n} raw={len(payload):,} bytes")
+        for encoding in compression.available_encodings():
+            _, low, high = compression.LEVELS[encoding]
+            for level in sorted({low, compression.LEVELS[encoding][0], high}):
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    c = compression.make_compressor(encoding, level)
+                    out = c.compress(payload) + c.flush(True)
+                cpu_ms = (time.perf_counter() - start) / args.repeat * 1000
+                saved = len(payload) - len(out)
+                print(
+                    f"{encoding:<5} level={level:<3} {len(out):>10,} bytes  saved {saved / len(payload):6.1%}"
+                    f"  {cpu_ms:8.3f} ms  {saved / 1024 / max(cpu_ms, 1e-6):10,.1f} KiB saved/ms"
+                )
+
+
+# ---------- 多 worker 吞吐 ----------
+
+def _http_json(port: int, method: str, path: str, body=None, headers=None):
+    import http.client
+    import json
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                 headers={"Content-Type": "application/json", **(headers or {})})
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp.status, json.loads(data) if data else None
+
+
+def _load_client(port: int, token: str, seconds: float) -> int:
+    import http.client
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers = {"Authorization": f"Bearer {token}"}
+    done = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        conn.request("GET", "/api/v1/tasks", headers=headers)
+        conn.getresponse().read()
+        done += 1
+    conn.close()
+    return done
+
+
+def bench_workers(args):
+    import signal
+    import subprocess
+    from concurrent.futures import ProcessPoolExecutor
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"cpus={os.cpu_count()} clients={args.clients} seconds={args.seconds}")
+    for n in [int(x) for x in args.workers.split(",")]:
+        port = args.port
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(here, "serve.py"), "--workers", str(n), "--port", str(port),
+             "--max-requests", "0"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(200):
+                try:
+                    if _http_json(port, "GET", "/health")[0] == 200:
+                        break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                print(f"workers={n}: server did not start")
+                continue
+            name = f"bench_{n}_{random.randint(0, 10**9)}"
+            _, data = _http_json(port, "POST", "/auth/register",
+                                 {"username": name, "email": f"{name}@example.com", "password": "P@ssw0rd123"})
+            token = data["access_token"]
+            for i in range(20):
+                _http_json(port, "POST", "/api/v1/tasks", {"title": f"task {i}"}, {"Authorization": f"Bearer {token}"})
+
+            with ProcessPoolExecutor(args.clients) as pool:
+                start = time.perf_counter()
+                futures = [pool.submit(_load_client, port, token, args.seconds) for _ in range(args.clients)]
+                total = sum(f.result() for f in futures)
+                elapsed = time.perf_counter() - start
+            print(f"workers={n:<3} {total:>9,} requests  {_rate(total, elapsed)}")
+        finally:
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
+# ---------- 冷启动 ----------
+
+# 只应在第一次使用时导入的模块
+DEFERRED_MODULES = ["passlib", "bcrypt", "jose", "jwt", "MySQLdb", "pymysql"]
+
+
+def bench_startup(args):
+    import statistics
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    code = f"import sys, main; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+
+    walls, cumulative = [], {}
+    loaded = ""
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=here, env=env,
+                              capture_output=True, text=True, check=True)
+        walls.append((time.perf_counter() - start) * 1000)
+        loaded = proc.stdout.strip()
+        for line in proc.stderr.splitlines():
+            # import time:  self [us] | cumulative | imported package
+            parts = line.split("|")
+            if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            cumulative.setdefault(parts[2].strip(), []).append(int(parts[1]))
+
+    median = statistics.median(walls)
+    print(f"python -c 'import main': median {median:.0f} ms over {args.runs} runs (process start included)")
+    print("slowest imports (cumulative, median):")
+    top = sorted(((statistics.median(v), k) for k, v in cumulative.items()), reverse=True)[:args.top]
+    for us, name in top:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: deferred modules imported at startup: {loaded}")
+        failed = True
+    if args.max_ms and median > args.max_ms:
+        print(f"FAIL: startup {median:.0f} ms exceeds --max-ms {args.max_ms}")
+        failed = True
+    return 1 if failed else 0
+
+
+# ---------- 热路径语句 ----------
+
+def bench_statements(args):
+    from sqlalchemy import and_, select
+
+    import models
+    from models import LicenseKey, Task, TaskArchive, User
+    from routers import auth, license, tasks
+
+    models.init_db()
+    raw = "BENC-HMAR-KKEY-0001"
+    with models.SessionLocal() as db:
+        user = User(username=f"bench_{random.randint(0, 10**9)}", email=f"b{random.randint(0, 10**9)}@example.com",
+                    password_hash="x", status=1)
+        db.add(user)
+        db.flush()
+        for i in range(args.tasks):
+            db.add(Task(user_id=user.id, title=f"task {i}", column_name="Done" if i % 3 == 0 else "To Do",
+                        completed=i % 3 == 0))
+        if db.execute(select(LicenseKey).where(LicenseKey.key_hash == models.hash_license_key(raw))).first() is None:
+            db.add(LicenseKey(key_hash=models.hash_license_key(raw), feature="pro"))
+        db.commit()
+        uid = user.id
+        tid = db.execute(select(Task.id).where(Task.user_id == uid).limit(1)).scalar_one()
+    kh = models.hash_license_key(raw)
+
+    # 之前的写法：每次调用构造 select()（或 Session.get）
+    def list_before(db, completed=None, column=None):
+        filters = [Task.user_id == uid]
+        if completed is not None:
+            filters.append(Task.completed == completed)
+        if column is not None:
+            filters.append(Task.column_name == column)
+        return db.execute(select(Task).where(and_(*filters)).order_by(Task.created_at.desc())).scalars().all()
+
+    def list_after(db, completed=None, column=None):
+        params = {"user_id": uid, "completed": completed, "column": column}
+        stmt = tasks._LIST_TASKS[(completed is not None, column is not None)]
+        return db.execute(stmt, {k: v for k, v in params.items() if v is not None}).scalars().all()
+
+    cases = [
+        ("get_current_user",
+         lambda db: db.get(User, uid),
+         lambda db: db.execute(auth._USER_BY_ID, {"user_id": uid}).scalar_one_or_none()),
+        ("get_task_or_404",
+         lambda db: db.get(Task, tid),
+         lambda db: db.execute(tasks._TASK_BY_ID, {"task_id": tid, "user_id": uid}).scalar_one_or_none()),
+        ("list_tasks",
+         lambda db: list_before(db),
+         lambda db: list_after(db)),
+        ("list_tasks completed+column",
+         lambda db: list_before(db, True, "Done"),
+         lambda db: list_after(db, True, "Done")),
+        ("list_tasks archived",
+         lambda db: db.execute(select(TaskArchive).where(TaskArchive.user_id == uid)
+                               .order_by(TaskArchive.created_at.desc())).scalars().all(),
+         lambda db: db.execute(tasks._LIST_ARCHIVED, {"user_id": uid}).scalars().all()),
+        ("_find_license_by_raw_key",
+         lambda db: db.execute(select(LicenseKey).where(LicenseKey.key_hash == kh)).scalar_one_or_none(),
+         lambda db: db.execute(license._LICENSE_BY_HASH, {"key_hash": kh}).scalar_one_or_none()),
+    ]
+
+    def per_call_us(fn) -> float:
+        with models.SessionLocal() as db:
+            fn(db)
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                fn(db)
+                db.expunge_all()
+            return (time.perf_counter() - start) / args.calls * 1e6
+
+    print(f"calls={args.calls} tasks/user={args.tasks} (SQLite, includes query execution)")
+    for name, before, after in cases:
+        b, a = per_call_us(before), per_call_us(after)
+        print(f"{name:<30} before {b:8.1f} us  after {a:8.1f} us  ({(b - a) / b:6.1%} less)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kanban backend benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("jwt", help="access token 解码吞吐（有/无缓存，各 JWT 实现）")
+    p.add_argument("--tokens", type=int, default=500)
+    p.add_argument("--requests", type=int, default=200_000)
+    p.add_argument("--cache-size", type=int, default=10_000)
+    p.set_defaults(func=bench_jwt)
+
+    p = sub.add_parser("shards", help="按分片数统计任务写入吞吐（SQLite 分片文件）")
+    p.add_argument("--shards", default="1,2,4")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--writes", type=int, default=4000)
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("sweep", help="许可过期清扫耗时（全量/增量）")
+    p.add_argument("--keys", type=int, default=1_000_000)
+    p.add_argument("--batch", type=int, default=1000)
+    p.set_defaults(func=bench_sweep)
+
+    p = sub.add_parser("compress", help="看板响应压缩：CPU 耗时与节省字节数")
+    p.add_argument("--tasks", default="20,200,2000")
+    p.add_argument("--words", type=int, default=40, help="描述的最大词数")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_compress)
+
+    p = sub.add_parser("workers", help="serve.py 按 worker 数统计 GET /api/v1/tasks 吞吐")
+    p.add_argument("--workers", default=f"1,{os.cpu_count() or 1}")
+    p.add_argument("--clients", type=int, default=8, help="压测客户端进程数")
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--port", type=int, default=18000)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("startup", help="import main 冷启动耗时（-X importtime），可作为回归门禁")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--top", type=int, default=15)
+    p.add_argument("--max-ms", type=float, default=0, help="中位数超过该值时返回非零退出码")
+    p.add_argument("--database-url", default="mysql+mysqldb://u:p@127.0.0.1:3306/db",
+                   help="默认使用 MySQL URL 以确认驱动未在导入时加载")
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("statements", help="热路径查询：每次构造 select() 与预构造语句的单次调用开销")
+    p.add_argument("--calls", type=int, default=20_000)
+    p.add_argument("--tasks", type=int, default=20)
+    p.set_defaults(func=bench_statements)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
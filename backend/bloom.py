@@ -0,0 +1,227 @@
+"""
+许可密钥的布隆过滤器：在查询 license_keys 之前排除不存在的密钥。
+
+- 启动时后台流式扫描 key_hash 构建，构建完成前所有请求照常查库；
+- 新密钥通过 add() 加入，或由按 id 增量拉取（tail refresh）补齐——
+  generate_license.py 在独立进程中写库，服务进程靠增量拉取发现新密钥；
+  并发插入时自增 id 的提交顺序可能与大小不一致（构建扫描期间同样如此），每次增量拉取
+  从已见最大 id 回看 LICENSE_FILTER_LOOKBACK_IDS 个 id，晚提交的小 id 也会被补上，
+  保证不出现假阴性；
+- 判定不存在时先做一次限频的增量拉取再下结论，避免新生成的密钥被误判为 404；
+- 周期性全量重建，以适应删除与容量增长。过滤器在各进程内存中，每个 worker 各自重建：
+  serve.py 预加载时在主进程构建一次，fork 出的 worker 直接沿用，之后的重建时间加随机
+  抖动，避免所有 worker 同时全表扫描。
+"""
+import logging
+import math
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import func, select
+
+import models
+from models import LicenseKey
+
+LICENSE_FILTER_ENABLED = os.getenv("LICENSE_FILTER_ENABLED", "1") == "1"
+LICENSE_FILTER_FP_RATE = float(os.getenv("LICENSE_FILTER_FP_RATE", "0.001"))
+LICENSE_FILTER_MAX_BYTES = int(os.getenv("LICENSE_FILTER_MAX_BYTES", str(8 * 1024 * 1024)))
+LICENSE_FILTER_REBUILD_SECONDS = int(os.getenv("LICENSE_FILTER_REBUILD_SECONDS", "3600"))
+# 判定不存在时增量拉取的最小间隔：暴力请求最多每秒触发一次轻量查询
+LICENSE_FILTER_MIN_REFRESH_SECONDS = float(os.getenv("LICENSE_FILTER_MIN_REFRESH_SECONDS", "1"))
+# 增量拉取的回看窗口（id 个数），应大于同时在途的插入数
+LICENSE_FILTER_LOOKBACK_IDS = int(os.getenv("LICENSE_FILTER_LOOKBACK_IDS", "1000"))
+
+logger = logging.getLogger("bloom")
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float = LICENSE_FILTER_FP_RATE, max_bytes: int = LICENSE_FILTER_MAX_BYTES):
+        capacity = max(capacity, 1)
+        bits = math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2))
+        self.num_bits = max(64, min(bits, max_bytes * 8))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key_hash: str):
+        # key_hash 本身是 SHA-256 十六进制串，直接切片做双重哈希
+        h1 = int(key_hash[:16], 16)
+        h2 = int(key_hash[16:32], 16) | 1
+        m = self.num_bits
+        return ((h1 + i * h2) % m for i in range(self.num_hashes))
+
+    def add(self, key_hash: str) -> None:
+        changed = False
+        for pos in self._positions(key_hash):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                changed = True
+        # 回看窗口会重复加入已有的密钥，不重复计数
+        if changed:
+            self.count += 1
+
+    def __contains__(self, key_hash: str) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key_hash))
+
+    def estimated_fp_rate(self) -> float:
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class LicenseKeyFilter:
+    def __init__(
+        self,
+        fp_rate: float = LICENSE_FILTER_FP_RATE,
+        max_bytes: int = LICENSE_FILTER_MAX_BYTES,
+        rebuild_seconds: int = LICENSE_FILTER_REBUILD_SECONDS,
+        min_refresh_seconds: float = LICENSE_FILTER_MIN_REFRESH_SECONDS,
+        lookback_ids: int = LICENSE_FILTER_LOOKBACK_IDS,
+    ):
+        self.fp_rate = fp_rate
+        self.max_bytes = max_bytes
+        self.rebuild_seconds = rebuild_seconds
+        self.min_refresh_seconds = min_refresh_seconds
+        self.lookback_ids = lookback_ids
+        self._filter: Optional[BloomFilter] = None
+        self._last_id = 0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {
+            "checks": 0,
+            "lookups_avoided": 0,
+            "passed": 0,
+            "false_positives": 0,
+            "tail_refreshes": 0,
+            "rebuilds": 0,
+        }
+        # might_exist 在请求线程中并发调用；计数单独加锁，不与刷新共用 _lock
+        self._stats_lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def build(self, bind=None, batch_size: int = 10000) -> None:
+        bind = bind or models.engine
+        with bind.connect() as conn:
+            total = conn.execute(select(func.count()).select_from(LicenseKey)).scalar() or 0
+            # 预留增长空间，避免在两次重建之间误判率升高
+            bf = BloomFilter(int(total * 1.5) + 1024, self.fp_rate, self.max_bytes)
+            last_id = 0
+            stmt = select(LicenseKey.id, LicenseKey.key_hash).order_by(LicenseKey.id)
+            for row in conn.execution_options(yield_per=batch_size).execute(stmt):
+                bf.add(row.key_hash)
+                last_id = row.id
+        with self._lock:
+            self._filter = bf
+            self._last_id = last_id
+            self._last_refresh = time.monotonic()
+            self._count("rebuilds")
+        # 构建期间新增（含 id 小于已扫描最大 id、晚提交）的密钥
+        self.refresh_tail(bind)
+
+    def refresh_tail(self, bind=None) -> int:
+        bind = bind or models.engine
+        with self._lock:
+            if self._filter is None:
+                return 0
+            last_id = self._last_id
+            self._last_refresh = time.monotonic()
+        with bind.connect() as conn:
+            rows = conn.execute(
+                select(LicenseKey.id, LicenseKey.key_hash)
+                .where(LicenseKey.id > last_id - self.lookback_ids)
+                .order_by(LicenseKey.id)
+            ).all()
+        with self._lock:
+            for row in rows:
+                self._filter.add(row.key_hash)
+            if rows:
+                self._last_id = max(self._last_id, rows[-1].id)
+            self._count("tail_refreshes")
+        return len(rows)
+
+    def add(self, key_hash: str) -> None:
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(key_hash)
+
+    def might_exist(self, key_hash: str) -> bool:
+        bf = self._filter
+        self._count("checks")
+        if bf is None or key_hash in bf:
+            self._count("passed")
+            return True
+        # 判定与更新刷新时间在同一把锁内：一批未知密钥同时到达时只有一个线程去拉取
+        with self._lock:
+            now = time.monotonic()
+            due = now - self._last_refresh >= self.min_refresh_seconds
+            if due:
+                self._last_refresh = now
+        if due:
+            self.refresh_tail()
+            if key_hash in self._filter:
+                self._count("passed")
+                return True
+        self._count("lookups_avoided")
+        return False
+
+    def record_false_positive(self) -> None:
+        self._count("false_positives")
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def snapshot(self) -> dict:
+        bf = self._filter
+        with self._stats_lock:
+            data = dict(self.stats, ready=bf is not None)
+        if bf is not None:
+            data.update(
+                items=bf.count,
+                bits=bf.num_bits,
+                hashes=bf.num_hashes,
+                bytes=len(bf.bits),
+                estimated_fp_rate=round(bf.estimated_fp_rate(), 6),
+            )
+        return data
+
+    def start(self) -> None:
+        if not LICENSE_FILTER_ENABLED or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="license-filter", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        # 从预加载的主进程继承了过滤器时，跳过启动时的构建
+        if self.ready and self._wait_rebuild():
+            return
+        while True:
+            try:
+                self.build()
+                # 过滤器规模与误判率只写日志，不经 API 对外暴露
+                logger.info("license filter rebuilt: %s", self.snapshot())
+            except Exception:
+                logger.exception("license filter build failed")
+            if self._wait_rebuild():
+                return
+
+    def _wait_rebuild(self) -> bool:
+        return self._stop.wait(self.rebuild_seconds * random.uniform(0.75, 1.25))
+
+
+license_filter = LicenseKeyFilter()
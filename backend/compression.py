@@ -0,0 +1,259 @@
+"""
+响应压缩（ASGI 中间件）。
+
+- 按 Accept-Encoding 协商 zstd / br / gzip（zstandard、brotli 未安装时跳过对应编码）；
+- 小于 COMPRESSION_MIN_SIZE 的响应原样返回，省去压缩的 CPU 开销；
+- 流式响应（StreamingResponse）逐块压缩并 flush，客户端无需等待整个响应体；
+  text/event-stream 不做最小长度缓冲，每个事件立即发出；
+- 压缩级别可按路由前缀配置，例如 COMPRESSION_ROUTE_LEVELS="/api/v1/tasks=4,/auth=1"。
+
+压缩后 ETag 改为弱校验（W/），If-Match 的解析已兼容。
+"""
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - 视部署环境而定
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - 视部署环境而定
+    zstandard = None
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# 服务端偏好顺序（客户端 q 值相同时使用）
+COMPRESSION_ENCODINGS = os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip")
+COMPRESSION_ROUTE_LEVELS = os.getenv("COMPRESSION_ROUTE_LEVELS", "")
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+)
+
+# 编码 -> (默认级别, 最小级别, 最大级别)
+LEVELS = {
+    "gzip": (6, 1, 9),
+    "br": (4, 0, 11),
+    "zstd": (3, 1, 22),
+}
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self, final: bool) -> bytes:
+        return self._obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _BrotliCompressor:
+    def __init__(self, level: int):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.process(data)
+
+    def flush(self, final: bool) -> bytes:
+        return self._obj.finish() if final else self._obj.flush()
+
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self, final: bool) -> bytes:
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+COMPRESSORS = {"gzip": _GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = _BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _ZstdCompressor
+
+
+def available_encodings(preferred: str = COMPRESSION_ENCODINGS) -> List[str]:
+    return [e.strip() for e in preferred.split(",") if e.strip() in COMPRESSORS]
+
+
+def make_compressor(encoding: str, level: Optional[int] = None):
+    default, low, high = LEVELS[encoding]
+    level = default if level is None else max(low, min(level, high))
+    return COMPRESSORS[encoding](level)
+
+
+def negotiate(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """按 q 值选择编码，q 相同时按服务端偏好；q=0 表示拒绝。"""
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        if name:
+            weights[name.strip()] = q
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for enc in encodings:
+        q = weights.get(enc, wildcard)
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+
+def parse_route_levels(value: str) -> List[Tuple[str, int]]:
+    routes = []
+    for item in value.split(","):
+        prefix, sep, level = item.strip().partition("=")
+        if sep and prefix:
+            routes.append((prefix, int(level)))
+    # 最长前缀优先
+    return sorted(routes, key=lambda r: len(r[0]), reverse=True)
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app,
+        minimum_size: int = COMPRESSION_MIN_SIZE,
+        route_levels: Optional[Dict[str, int]] = None,
+        encodings: str = COMPRESSION_ENCODINGS,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = available_encodings(encodings)
+        if route_levels is None:
+            self.route_levels = parse_route_levels(COMPRESSION_ROUTE_LEVELS)
+        else:
+            self.route_levels = sorted(route_levels.items(), key=lambda r: len(r[0]), reverse=True)
+
+    def level_for(self, path: str) -> Optional[int]:
+        for prefix, level in self.route_levels:
+            if path.startswith(prefix):
+                return level
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = negotiate(accept, self.encodings) if accept else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressingSender(send, encoding, self.level_for(scope["path"]), self.minimum_size)
+        await self.app(scope, receive, responder)
+
+
+class _CompressingSender:
+    def __init__(self, send, encoding: str, level: Optional[int], minimum_size: int):
+        self.send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.start = None
+        self.passthrough = False
+        self.compressor = None
+        self.buffer: List[bytes] = []
+        self.buffered = 0
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self._on_start(message)
+            if self.passthrough:
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is not None:
+            await self._send_compressed(body, more_body)
+            return
+
+        self.buffer.append(body)
+        self.buffered += len(body)
+        if self.buffered < self.minimum_size:
+            if more_body:
+                return
+            # 整个响应都小于阈值：原样发出
+            await self.send(self.start)
+            await self.send({"type": "http.response.body", "body": b"".join(self.buffer)})
+            return
+
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.compressor = make_compressor(self.encoding, self.level)
+        headers = self._compressed_headers()
+        if more_body:
+            await self.send(dict(self.start, headers=headers))
+            await self._send_compressed(data, True)
+        else:
+            out = self.compressor.compress(data) + self.compressor.flush(True)
+            headers.append((b"content-length", str(len(out)).encode("latin-1")))
+            await self.send(dict(self.start, headers=headers))
+            await self.send({"type": "http.response.body", "body": out})
+
+    def _on_start(self, message) -> None:
+        self.start = message
+        status = message["status"]
+        content_type = b""
+        for name, value in message.get("headers", []):
+            lname = name.lower()
+            if lname == b"content-encoding":
+                self.passthrough = True
+            elif lname == b"content-type":
+                content_type = value.lower()
+        ctype = content_type.decode("latin-1")
+        if status < 200 or status in (204, 304) or not ctype.startswith(COMPRESSIBLE_TYPES):
+            self.passthrough = True
+        elif ctype.startswith("text/event-stream"):
+            self.minimum_size = 0
+
+    def _compressed_headers(self) -> list:
+        headers = []
+        vary = None
+        for name, value in self.start.get("headers", []):
+            lname = name.lower()
+            if lname == b"content-length":
+                continue
+            if lname == b"vary":
+                vary = value
+                continue
+            if lname == b"etag" and not value.startswith(b"W/"):
+                value = b"W/" + value
+            headers.append((name, value))
+        headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+        return headers
+
+    async def _send_compressed(self, body: bytes, more_body: bool) -> None:
+        out = self.compressor.compress(body) + self.compressor.flush(not more_body)
+        await self.send({"type": "http.response.body", "body": out, "more_body": more_body})
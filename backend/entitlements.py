@@ -0,0 +1,262 @@
+"""
+许可过期清扫与授权状态（entitlement_state）维护。
+
+- 激活时由 routers/license.py 写入 entitlement_state，并把到期时间加入清扫器的小顶堆；
+- 清扫线程睡到堆顶（最近的到期时间）醒来，沿 ix_license_validity (is_used, expires_at)
+  分批扫描刚到期的密钥，把对应用户的授权状态置为失效；
+- 上线或数据修复时用 --rebuild 从 user_licenses 重新计算全部授权状态。
+
+用法：
+    python entitlements.py --rebuild
+    python entitlements.py --sweep
+"""
+import argparse
+import heapq
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+
+import models
+from models import EntitlementState, LicenseKey, UserLicense, dialect_insert, utcnow
+
+ENTITLEMENT_SWEEP_BATCH = int(os.getenv("ENTITLEMENT_SWEEP_BATCH", "1000"))
+# 最长睡眠时间：兜底发现其他进程激活的许可
+ENTITLEMENT_SWEEP_MAX_SLEEP = int(os.getenv("ENTITLEMENT_SWEEP_MAX_SLEEP", "300"))
+ENTITLEMENT_SWEEPER_ENABLED = os.getenv("ENTITLEMENT_SWEEPER_ENABLED", "1") == "1"
+
+logger = logging.getLogger("entitlements")
+
+
+def is_valid(valid_until: Optional[datetime], now: Optional[datetime] = None) -> bool:
+    return valid_until is None or valid_until >= (now or utcnow())
+
+
+def record_activation(db, user_id: int, feature: Optional[str], valid_until: Optional[datetime]) -> None:
+    """在会话当前事务中写入用户的授权状态。
+
+    用 upsert 而非“先查后插”：同一用户的并发首次激活不会在主键上冲突。
+    """
+    conn = db.connection(bind_arguments={"mapper": EntitlementState.__mapper__})
+    values = {"licensed": True, "feature": feature, "valid_until": valid_until, "updated_at": utcnow()}
+    stmt = dialect_insert(conn, EntitlementState.__table__).values(user_id=user_id, **values)
+    if conn.dialect.name == "mysql":
+        stmt = stmt.on_duplicate_key_update(values)
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=["user_id"], set_=values)
+    conn.execute(stmt)
+
+
+def expired_key_batches(conn, since: Optional[datetime], now: datetime, batch_size: int):
+    """沿 (is_used, expires_at) 索引做范围扫描，逐批返回 (since, now] 内到期的密钥 id。
+
+    未使用的单次密钥不可能有激活记录，因此 is_used=0 时只看多次密钥。
+    """
+    for is_used in (True, False):
+        cursor = since
+        while True:
+            conds = [LicenseKey.is_used == is_used, LicenseKey.expires_at <= now]
+            if not is_used:
+                conds.append(LicenseKey.is_multi_use == True)  # noqa: E712
+            page = conds + ([LicenseKey.expires_at > cursor] if cursor is not None else [])
+            rows = conn.execute(
+                select(LicenseKey.id, LicenseKey.expires_at)
+                .where(*page)
+                .order_by(LicenseKey.expires_at)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            ids = [r.id for r in rows]
+            if len(rows) == batch_size:
+                # 补齐与本批最后一个到期时间相同、被 LIMIT 截断的行
+                boundary = rows[-1].expires_at
+                seen = [r.id for r in rows if r.expires_at == boundary]
+                ids += conn.execute(
+                    select(LicenseKey.id).where(*conds, LicenseKey.expires_at == boundary, LicenseKey.id.not_in(seen))
+                ).scalars().all()
+            yield ids
+            if len(rows) < batch_size:
+                break
+            cursor = rows[-1].expires_at
+
+
+def sweep_expired(
+    bind=None,
+    since: Optional[datetime] = None,
+    now: Optional[datetime] = None,
+    batch_size: int = ENTITLEMENT_SWEEP_BATCH,
+) -> int:
+    bind = bind or models.engine
+    now = now or utcnow()
+    revoked = 0
+    with bind.connect() as conn:
+        for key_ids in expired_key_batches(conn, since, now, batch_size):
+            users = select(UserLicense.user_id).where(UserLicense.license_key_id.in_(key_ids))
+            result = conn.execute(
+                update(EntitlementState)
+                .where(
+                    EntitlementState.licensed == True,  # noqa: E712
+                    EntitlementState.valid_until <= now,
+                    EntitlementState.user_id.in_(users),
+                )
+                .values(licensed=False)
+            )
+            conn.commit()
+            revoked += result.rowcount
+    return revoked
+
+
+def next_expiry(bind=None, after: Optional[datetime] = None) -> Optional[datetime]:
+    bind = bind or models.engine
+    after = after or utcnow()
+    with bind.connect() as conn:
+        candidates = [
+            conn.execute(select(func.min(LicenseKey.expires_at)).where(*conds)).scalar()
+            for conds in (
+                [LicenseKey.is_used == True, LicenseKey.expires_at > after],  # noqa: E712
+                [LicenseKey.is_used == False, LicenseKey.is_multi_use == True, LicenseKey.expires_at > after],  # noqa: E712
+            )
+        ]
+    candidates = [c for c in candidates if c is not None]
+    return min(candidates) if candidates else None
+
+
+def rebuild_entitlements(bind=None, batch_size: int = ENTITLEMENT_SWEEP_BATCH) -> int:
+    """从 user_licenses 重新计算授权状态：每个用户取最近一次激活的密钥。"""
+    bind = bind or models.engine
+    now = utcnow()
+    stmt = (
+        select(UserLicense.user_id, LicenseKey.feature, LicenseKey.expires_at)
+        .join(LicenseKey, LicenseKey.id == UserLicense.license_key_id)
+        .order_by(UserLicense.user_id, UserLicense.activated_at, UserLicense.id)
+    )
+    latest = {}
+    with bind.connect() as conn:
+        for row in conn.execution_options(yield_per=batch_size).execute(stmt):
+            latest[row.user_id] = row
+    rows = [
+        {
+            "user_id": r.user_id,
+            "licensed": is_valid(r.expires_at, now),
+            "feature": r.feature,
+            "valid_until": r.expires_at,
+            "updated_at": now,
+        }
+        for r in latest.values()
+    ]
+    with bind.begin() as conn:
+        conn.execute(delete(EntitlementState))
+        for i in range(0, len(rows), batch_size):
+            conn.execute(insert(EntitlementState), rows[i:i + batch_size])
+    return len(rows)
+
+
+def needs_rebuild(bind=None) -> bool:
+    bind = bind or models.engine
+    with bind.connect() as conn:
+        has_state = conn.execute(select(EntitlementState.user_id).limit(1)).first() is not None
+        has_licenses = conn.execute(select(UserLicense.id).limit(1)).first() is not None
+    return has_licenses and not has_state
+
+
+class EntitlementSweeper:
+    """小顶堆定时器：睡到最近的到期时间，醒来后批量清扫。"""
+
+    def __init__(self, max_sleep: int = ENTITLEMENT_SWEEP_MAX_SLEEP):
+        self.max_sleep = max_sleep
+        self.last_swept: Optional[datetime] = None
+        self.sweeps = 0
+        self.revoked = 0
+        self._heap: List[datetime] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, when: Optional[datetime]) -> None:
+        # 未运行清扫的进程（非选主进程）不必记录：清扫进程按 max_sleep 兜底并从库中取下一个到期时间
+        if when is None or self._thread is None:
+            return
+        with self._cond:
+            heapq.heappush(self._heap, when)
+            if self._heap[0] == when:
+                self._cond.notify()
+
+    def sweep(self, now: Optional[datetime] = None) -> int:
+        now = now or utcnow()
+        revoked = sweep_expired(since=self.last_swept, now=now)
+        self.last_swept = now
+        self.sweeps += 1
+        self.revoked += revoked
+        with self._cond:
+            while self._heap and self._heap[0] <= now:
+                heapq.heappop(self._heap)
+        self.schedule(next_expiry(after=now))
+        return revoked
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="entitlement-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _seconds_until_next(self) -> float:
+        if not self._heap:
+            return self.max_sleep
+        delay = (self._heap[0] - utcnow()).total_seconds()
+        return max(0.0, min(delay, self.max_sleep))
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("entitlement sweep failed")
+            with self._cond:
+                # 被更早的到期时间唤醒时重新计算等待时长；超时即到期（或兜底）
+                while not self._stopped:
+                    delay = self._seconds_until_next()
+                    if delay <= 0 or not self._cond.wait(delay):
+                        break
+                if self._stopped:
+                    return
+
+
+entitlement_sweeper = EntitlementSweeper()
+
+
+def start_sweeper() -> None:
+    if not ENTITLEMENT_SWEEPER_ENABLED:
+        return
+    if needs_rebuild():
+        logger.info("rebuilt %d entitlement rows", rebuild_entitlements())
+    entitlement_sweeper.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Entitlement state maintenance")
+    parser.add_argument("--rebuild", action="store_true", help="从 user_licenses 重新计算授权状态")
+    parser.add_argument("--sweep", action="store_true", help="立即清扫已到期的授权")
+    args = parser.parse_args()
+
+    models.init_db()
+    if args.rebuild:
+        print(f"rebuilt {rebuild_entitlements()} entitlement rows")
+    if args.sweep or not args.rebuild:
+        print(f"revoked {sweep_expired()} expired entitlements")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+幂等键（Idempotency-Key）。
+
+客户端超时重试时携带同一个 Idempotency-Key，服务端只执行一次：
+- 首次执行成功后保存响应（状态码、JSON、ETag），保留 IDEMPOTENCY_TTL_SECONDS 秒；
+- 重放直接由存储返回（带 Idempotent-Replayed: true），不访问任务表与许可表；只重放
+  REPLAYED_HEADERS 中的响应头，首次执行的 Set-Cookie（读己之写的主库固定 Cookie）不重放：
+  重放请求本身没有写入，客户端在首次响应中已拿到该 Cookie，丢失时最多读到稍旧的副本；
+- 同一键的并发请求等待正在执行的那次完成，而不是再执行一遍；等待前先结束请求会话的
+  事务、把连接还给连接池，重试风暴不会占满连接池；等待超时返回 409（带 Retry-After）；
+- 同一键但请求内容不同返回 422。
+
+存储为进程内 LRU；IDEMPOTENCY_DB_ENABLED=1 时同时写 idempotency_keys 表，供多进程、
+多实例共享（占位行 status_code 为空表示执行中）。占位行带持有者标识，租约按请求超时
+（IDEMPOTENCY_LEASE_SECONDS，默认 SERVE_TIMEOUT 的两倍）计算：仍在执行的请求不会被其他
+进程接管，进程崩溃后键在租约到期后释放；释放与写入结果只作用于自己持有的占位行。
+只保存成功响应：执行出错时释放占位，客户端可用同一个键重试。
+"""
+import hashlib
+import json
+import os
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from models import IdempotencyRecord, utcnow
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# 并发重复请求等待首个请求完成的最长时间
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+IDEMPOTENCY_POLL_SECONDS = float(os.getenv("IDEMPOTENCY_POLL_SECONDS", "0.05"))
+IDEMPOTENCY_DB_ENABLED = os.getenv("IDEMPOTENCY_DB_ENABLED", "0") == "1"
+# 占位行租约：超过请求超时的执行已被 worker 终止，取两倍留余量
+IDEMPOTENCY_LEASE_SECONDS = float(
+    os.getenv("IDEMPOTENCY_LEASE_SECONDS", str(2 * int(os.getenv("SERVE_TIMEOUT", "60"))))
+)
+
+MAX_KEY_LENGTH = 128
+RETRY_AFTER_SECONDS = 1
+REPLAYED_HEADERS = ("ETag",)
+
+Key = Tuple[int, str, str]
+
+logger = logging.getLogger("idempotency")
+
+
+def fingerprint(payload) -> str:
+    data = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        ttl: int = IDEMPOTENCY_TTL_SECONDS,
+        max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+        wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS,
+        use_db: bool = IDEMPOTENCY_DB_ENABLED,
+        bind=None,
+        lease_seconds: float = IDEMPOTENCY_LEASE_SECONDS,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        self.lease_seconds = lease_seconds
+        self.use_db = use_db
+        self.bind = bind
+        # key -> (过期时间 monotonic, fingerprint, 保存的响应)
+        self._entries: "OrderedDict[Key, Tuple[float, str, dict]]" = OrderedDict()
+        # key -> (fingerprint, 完成事件)
+        self._inflight: Dict[Key, Tuple[str, threading.Event]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"executed": 0, "replayed": 0, "waited": 0, "mismatched": 0}
+        self._stats_lock = threading.Lock()
+
+    def run(
+        self,
+        user_id: int,
+        scope: str,
+        idem_key: Optional[str],
+        payload,
+        execute: Callable[[], object],
+        response: Optional[Response] = None,
+        status_code: int = status.HTTP_200_OK,
+        db: Optional[Session] = None,
+    ):
+        """有幂等键时最多执行一次 execute()，其余请求重放保存的响应。
+
+        db 为请求会话：需要等待其他请求时先结束其事务，不在等待期间占用连接。"""
+        if idem_key is None:
+            return execute()
+        idem_key = idem_key.strip()
+        if not idem_key or len(idem_key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Idempotency-Key")
+        key = (user_id, scope, idem_key)
+        fp = fingerprint(payload)
+
+        saved, owner = self._acquire(key, fp, db)
+        if saved is not None:
+            self._count("replayed")
+            headers = dict(saved["headers"], **{"Idempotent-Replayed": "true"})
+            return JSONResponse(status_code=saved["status"], content=saved["body"], headers=headers)
+
+        try:
+            result = execute()
+            self._count("executed")
+            headers = {h: response.headers[h] for h in REPLAYED_HEADERS if response is not None and h in response.headers}
+            saved = {"status": status_code, "body": jsonable_encoder(result), "headers": headers}
+            return result
+        finally:
+            self._release(key, fp, saved, owner)
+
+    # ---------- 占位与等待 ----------
+
+    def _acquire(self, key: Key, fp: str, db: Optional[Session] = None) -> Tuple[Optional[dict], Optional[str]]:
+        """返回 (已保存的响应, None)；响应为 None 表示本请求取得执行权，此时第二项为
+        占位行的持有者标识（未启用数据库时为 None）。"""
+        deadline = time.monotonic() + self.wait_seconds
+        waited = False
+        while True:
+            with self._lock:
+                saved = self._get(key, fp)
+                if saved is not None:
+                    return saved, None
+                inflight = self._inflight.get(key)
+                if inflight is None:
+                    self._inflight[key] = (fp, threading.Event())
+            if inflight is not None:
+                self._check(inflight[0], fp)
+                if not waited:
+                    self._start_waiting(db)
+                    waited = True
+                if not inflight[1].wait(max(0.0, deadline - time.monotonic())):
+                    self._in_progress()
+                continue
+            if not self.use_db:
+                return None, None
+            try:
+                saved, owner = self._db_acquire(key, fp, deadline, db)
+            except BaseException:
+                self._release(key, fp, None)
+                raise
+            if saved is not None:
+                self._release(key, fp, saved)
+            return saved, owner
+
+    def _release(self, key: Key, fp: str, saved: Optional[dict], owner: Optional[str] = None) -> None:
+        if owner is not None:
+            self._db_release(key, saved, owner)
+        with self._lock:
+            if saved is not None:
+                self._put(key, fp, saved)
+            inflight = self._inflight.pop(key, None)
+        if inflight is not None:
+            inflight[1].set()
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _start_waiting(self, db: Optional[Session]) -> None:
+        self._count("waited")
+        if db is not None:
+            # 此前只有鉴权查询，回滚即可结束事务并归还连接
+            db.rollback()
+
+    def _check(self, stored_fp: str, fp: str) -> None:
+        if stored_fp != fp:
+            self._count("mismatched")
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Idempotency-Key was already used with a different request",
+            )
+
+    def _in_progress(self) -> None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still in progress",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+
+    # ---------- 进程内 LRU（调用方持有 _lock） ----------
+
+    def _get(self, key: Key, fp: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, stored_fp, saved = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._check(stored_fp, fp)
+        self._entries.move_to_end(key)
+        return saved
+
+    def _put(self, key: Key, fp: str, saved: dict) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, fp, saved)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # ---------- idempotency_keys 表 ----------
+
+    def _where(self, key: Key):
+        user_id, scope, idem_key = key
+        return (
+            IdempotencyRecord.user_id == user_id,
+            IdempotencyRecord.scope == scope,
+            IdempotencyRecord.idem_key == idem_key,
+        )
+
+    def _db_acquire(
+        self, key: Key, fp: str, deadline: float, db: Optional[Session] = None,
+    ) -> Tuple[Optional[dict], Optional[str]]:
+        bind = self.bind or models.engine
+        user_id, scope, idem_key = key
+        waited = False
+        while True:
+            now = utcnow()
+            with bind.begin() as conn:
+                conn.execute(delete(IdempotencyRecord).where(*self._where(key), IdempotencyRecord.expires_at < now))
+            owner = uuid.uuid4().hex
+            try:
+                with bind.begin() as conn:
+                    # 占位行在租约到期后失效，避免进程崩溃后键被永久占用
+                    conn.execute(insert(IdempotencyRecord).values(
+                        user_id=user_id, scope=scope, idem_key=idem_key, fingerprint=fp, owner=owner,
+                        expires_at=now + timedelta(seconds=self.lease_seconds),
+                    ))
+                return None, owner
+            except IntegrityError:
+                pass
+            with bind.connect() as conn:
+                row = conn.execute(
+                    select(IdempotencyRecord.fingerprint, IdempotencyRecord.status_code, IdempotencyRecord.response)
+                    .where(*self._where(key))
+                ).first()
+            if row is None:
+                continue
+            self._check(row.fingerprint, fp)
+            if row.status_code is not None:
+                return json.loads(row.response), None
+            # 其他进程正在执行：轮询直到完成
+            if time.monotonic() >= deadline:
+                self._in_progress()
+            if not waited:
+                self._start_waiting(db)
+                waited = True
+            time.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    def _db_release(self, key: Key, saved: Optional[dict], owner: str) -> None:
+        bind = self.bind or models.engine
+        mine = (*self._where(key), IdempotencyRecord.owner == owner, IdempotencyRecord.status_code.is_(None))
+        with bind.begin() as conn:
+            if saved is None:
+                conn.execute(delete(IdempotencyRecord).where(*mine))
+                return
+            result = conn.execute(
+                update(IdempotencyRecord)
+                .where(*mine)
+                .values(
+                    status_code=saved["status"],
+                    response=json.dumps(saved),
+                    owner=None,
+                    expires_at=utcnow() + timedelta(seconds=self.ttl),
+                )
+            )
+        if result.rowcount == 0:
+            # 租约已过期并被其他请求接管：不覆盖对方的结果
+            logger.warning("idempotency lease lost for %s/%s; result not stored", key[1], key[2])
+
+
+idempotency_store = IdempotencyStore()
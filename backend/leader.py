@@ -0,0 +1,167 @@
+"""
+单实例后台任务（任务归档、授权清扫）的选主。
+
+多 worker / 多实例部署时每个进程都会执行 startup 钩子，而这些任务只应由一个进程运行：
+- MySQL：各进程用 GET_LOCK 争抢同名锁，持锁连接一直保持打开；进程退出或连接断开后锁
+  自动释放，其他进程在下一次重试时接管；
+- 其他数据库（本地 SQLite）：用文件锁（fcntl.flock），语义相同，仅限单机。
+BACKGROUND_JOBS=0 时本进程不参选。
+"""
+import logging
+import os
+import tempfile
+import threading
+from typing import Callable, Optional
+
+from sqlalchemy import text
+
+import models
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 非 POSIX 平台
+    fcntl = None
+
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
+JOB_LOCK_NAME = os.getenv("JOB_LOCK_NAME", "kanban-background-jobs")
+JOB_LOCK_RETRY_SECONDS = float(os.getenv("JOB_LOCK_RETRY_SECONDS", "30"))
+
+logger = logging.getLogger("leader")
+
+
+class _MySQLLock:
+    def __init__(self, name: str):
+        self.name = name
+        self._conn = None
+
+    def acquire(self) -> bool:
+        conn = models.engine.connect()
+        try:
+            got = conn.execute(text("SELECT GET_LOCK(:name, 0)"), {"name": self.name}).scalar()
+        except Exception:
+            conn.close()
+            raise
+        if got != 1:
+            conn.close()
+            return False
+        self._conn = conn
+        return True
+
+    def held(self) -> bool:
+        # 同时起到保活作用，避免持锁连接因 wait_timeout 被服务端断开
+        try:
+            return bool(self._conn.execute(
+                text("SELECT IS_USED_LOCK(:name) = CONNECTION_ID()"), {"name": self.name}
+            ).scalar())
+        except Exception:
+            return False
+
+    def release(self) -> None:
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": self.name})
+        except Exception:
+            pass
+        finally:
+            self._conn.close()
+            self._conn = None
+
+
+class _FileLock:
+    def __init__(self, name: str):
+        self.path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> bool:
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def held(self) -> bool:
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _make_lock(name: str):
+    if models.engine.dialect.name == "mysql":
+        return _MySQLLock(name)
+    return _FileLock(name)
+
+
+class JobLeader:
+    """抢到锁后调用 on_elected 启动任务，失去锁或停止时调用 on_demoted。"""
+
+    def __init__(
+        self,
+        on_elected: Callable[[], None],
+        on_demoted: Callable[[], None],
+        name: str = JOB_LOCK_NAME,
+        retry_seconds: float = JOB_LOCK_RETRY_SECONDS,
+        enabled: bool = BACKGROUND_JOBS,
+    ):
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.name = name
+        self.retry_seconds = retry_seconds
+        self.enabled = enabled
+        self.leading = False
+        self._lock = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="job-leader", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                if not self.leading:
+                    self._try_elect()
+                elif not self._lock.held():
+                    logger.warning("lost background job lock %s", self.name)
+                    self._demote()
+            except Exception:
+                logger.exception("background job election failed")
+            if self._stop.wait(self.retry_seconds):
+                break
+        if self.leading:
+            self._demote()
+
+    def _try_elect(self) -> None:
+        lock = _make_lock(self.name)
+        if not lock.acquire():
+            return
+        self._lock = lock
+        self.leading = True
+        logger.info("running background jobs in pid %d", os.getpid())
+        self.on_elected()
+
+    def _demote(self) -> None:
+        try:
+            self.on_demoted()
+        finally:
+            self.leading = False
+            self._lock.release()
+            self._lock = None
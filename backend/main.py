@@ -1,10 +1,24 @@
+import os
+
+from anyio import to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.orm import configure_mappers
 
 from routers import tasks as tasks_router
 from routers import auth as auth_router
 from routers import license as license_router  
 from models import init_db  
+from archive import archive_worker
+from entitlements import entitlement_sweeper, start_sweeper
+from bloom import license_filter
+from activity import activity_log
+from leader import JobLeader
+from compression import CompressionMiddleware
+from profiling import ProfilingMiddleware
+
+# 导入时即完成 ORM 映射配置（不涉及建表），预加载后 fork 的 worker 直接共享
+configure_mappers()
 
 CORS_ORIGINS = [
     "http://localhost:3000",
@@ -12,6 +26,22 @@ CORS_ORIGINS = [
     "http://8.217.112.161:8000",
 ]
 
+# serve.py 在主进程建表一次后置为 0，避免多个 worker 并发执行 DDL
+INIT_DB_ON_STARTUP = os.getenv("INIT_DB_ON_STARTUP", "1") == "1"
+# 同步路由所用线程池的大小（0 表示使用 anyio 默认的 40）
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "0"))
+
+# 归档与授权清扫每个部署只需一个进程运行：由抢到锁的进程启动（见 leader.py）
+def _start_singleton_jobs():
+    archive_worker.start()
+    start_sweeper()
+
+def _stop_singleton_jobs():
+    archive_worker.stop()
+    entitlement_sweeper.stop()
+
+job_leader = JobLeader(_start_singleton_jobs, _stop_singleton_jobs)
+
 app = FastAPI(title="Simple Login API", version="0.4.0")
 
 app.add_middleware(
@@ -21,11 +51,28 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 按 Accept-Encoding 压缩较大的响应（见 compression.py）
+app.add_middleware(CompressionMiddleware)
+# 按需单请求剖析与 SQL 检查（见 profiling.py，默认关闭）
+app.add_middleware(ProfilingMiddleware)
 
 @app.on_event("startup")
 def on_startup():
+    if THREADPOOL_SIZE > 0:
+        to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
     # 自动建表
-    init_db()
+    if INIT_DB_ON_STARTUP:
+        init_db()
+    job_leader.start()
+    license_filter.start()
+    activity_log.start()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    job_leader.stop()
+    license_filter.stop()
+    # 写完队列中剩余的任务事件
+    activity_log.stop()
 
 @app.get("/health")
 def health():
@@ -0,0 +1,238 @@
+"""
+按需性能剖析与 SQL 检查（开发 / 测试 / 线上排查）。
+
+1) 单请求采样剖析：请求头 X-Profile 与 PROFILE_TOKEN 一致，或按 PROFILE_SAMPLE_RATE
+   随机抽样时，请求期间后台线程每 PROFILE_INTERVAL 秒采集一次调用栈，结束后把折叠栈
+   （flamegraph.pl / speedscope 可直接读取）写入 PROFILE_DIR，响应带 X-Profile-Id 与
+   Server-Timing（数据库耗时、查询数）。采样覆盖进程内除后台工作线程外的所有线程，
+   并发请求会混入结果，线上排查时建议配合低并发或单独 worker 使用。
+
+2) SQL 检查：SQL_CHECKS=log 或 raise 时，按请求（contextvars）记录执行的语句：
+   - 关系属性的懒加载（lazy load）；
+   - 完全相同的语句与参数重复执行；
+   - 同一语句执行次数达到 SQL_REPEAT_THRESHOLD（典型的 N+1）。
+   log 模式在请求结束时记录警告；raise 模式在发生时抛出 QueryCheckError，测试中等同于
+   把所有关系配置为 lazy="raise_on_sql" 并额外检查重复语句。
+"""
+import contextvars
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+SQL_CHECKS = os.getenv("SQL_CHECKS", "off")  # off / log / raise
+SQL_REPEAT_THRESHOLD = int(os.getenv("SQL_REPEAT_THRESHOLD", "5"))
+
+# 后台工作线程不属于任何请求
+BACKGROUND_THREADS = {
+    "license-filter", "activity-writer", "entitlement-sweeper", "task-archiver", "job-leader", "profiler",
+}
+
+logger = logging.getLogger("profiling")
+
+
+class QueryCheckError(RuntimeError):
+    pass
+
+
+class RequestQueries:
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Counter = Counter()
+        self.exact: Counter = Counter()
+        self.lazy_loads: Counter = Counter()
+        self.problems: List[str] = []
+
+    def _flag(self, message: str) -> None:
+        if message in self.problems:
+            return
+        self.problems.append(message)
+        if SQL_CHECKS == "raise":
+            raise QueryCheckError(f"{self.label}: {message}")
+
+    def on_statement(self, statement: str, parameters) -> None:
+        self.count += 1
+        self.statements[statement] += 1
+        key = (statement, repr(parameters))
+        self.exact[key] += 1
+        if self.exact[key] == 2:
+            self._flag(f"duplicate statement: {_short(statement)}")
+        if self.statements[statement] == SQL_REPEAT_THRESHOLD:
+            self._flag(f"statement executed {SQL_REPEAT_THRESHOLD}+ times (N+1?): {_short(statement)}")
+
+    def on_lazy_load(self, attribute: str) -> None:
+        self.lazy_loads[attribute] += 1
+        self._flag(f"lazy load of {attribute}")
+
+
+_current: contextvars.ContextVar[Optional[RequestQueries]] = contextvars.ContextVar("request_queries", default=None)
+
+
+def _short(statement: str, limit: int = 160) -> str:
+    s = " ".join(statement.split())
+    return s if len(s) <= limit else s[:limit] + "..."
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracker = _current.get()
+    if tracker is None:
+        return
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+    tracker.on_statement(statement, parameters)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracker = _current.get()
+    starts = conn.info.get("query_start")
+    if tracker is None or not starts:
+        return
+    tracker.seconds += time.perf_counter() - starts.pop()
+
+
+def _do_orm_execute(orm_execute_state):
+    tracker = _current.get()
+    if tracker is None or not orm_execute_state.is_select or orm_execute_state.lazy_loaded_from is None:
+        return
+    path = orm_execute_state.loader_strategy_path
+    tracker.on_lazy_load(str(path[-1]) if path else "relationship")
+
+
+_installed = False
+
+
+def install_sql_hooks() -> None:
+    """对所有 Engine / Session 注册监听（幂等）；未处于被跟踪的请求中时监听立即返回。"""
+    global _installed
+    if _installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Session, "do_orm_execute", _do_orm_execute)
+    _installed = True
+
+
+class track_queries:
+    """在请求之外（脚本、测试）跟踪一段代码中的查询。"""
+
+    def __init__(self, label: str = "block"):
+        self.tracker = RequestQueries(label)
+
+    def __enter__(self) -> RequestQueries:
+        install_sql_hooks()
+        self._token = _current.set(self.tracker)
+        return self.tracker
+
+    def __exit__(self, *exc):
+        _current.reset(self._token)
+        return False
+
+
+# ---------- 采样剖析 ----------
+
+class StackSampler:
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        names: Dict[int, str] = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if names.get(ident) in BACKGROUND_THREADS:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                # 空闲线程（事件循环 select、线程池等待）不计入
+                if stack and stack[0].startswith(("select ", "wait ", "_worker ", "poll ")):
+                    continue
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in self.samples.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+def _should_profile(headers: Dict[bytes, bytes]) -> bool:
+    token = headers.get(b"x-profile")
+    if token is not None and PROFILE_TOKEN and token.decode("latin-1") == PROFILE_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        install_sql_hooks()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile = _should_profile(dict(scope["headers"]))
+        if not profile and SQL_CHECKS == "off":
+            await self.app(scope, receive, send)
+            return
+
+        label = f'{scope["method"]} {scope["path"]}'
+        tracker = RequestQueries(label)
+        token = _current.set(tracker)
+        sampler = StackSampler() if profile else None
+        profile_id = uuid.uuid4().hex[:12] if profile else None
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if profile and message["type"] == "http.response.start":
+                total_ms = (time.perf_counter() - start) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_id.encode()))
+                headers.append((b"server-timing", (
+                    f'app;dur={total_ms:.1f}, db;dur={tracker.seconds * 1000:.1f};desc="{tracker.count} queries"'
+                ).encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        if sampler is not None:
+            sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if sampler is not None:
+                sampler.stop()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                path = os.path.join(PROFILE_DIR, f"{profile_id}.folded")
+                sampler.write(path)
+                logger.info("%s profiled: %d samples, %d queries -> %s",
+                            label, sum(sampler.samples.values()), tracker.count, path)
+            if tracker.problems and SQL_CHECKS == "log":
+                logger.warning("%s: %d queries; %s", label, tracker.count, "; ".join(tracker.problems))
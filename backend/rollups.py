@@ -0,0 +1,267 @@
+"""
+看板统计汇总（task_stage_counts / task_daily_stats）。
+
+- 列计数（task_stage_counts）在修改任务的同一事务里更新（add_stage / shift_stage），
+  与任务表始终一致；
+- 按天统计（task_daily_stats）依赖进入某列的时间，由写入线程在写事件的同一事务里调用
+  apply_events() 增量累加（见 activity.py）；事件丢弃或写入失败时写入线程按用户重建。
+
+统计查询只读汇总表，代价与天数相关而与任务数无关。日志上线前已存在的任务需执行一次重建。
+
+用法：
+    python rollups.py --rebuild
+"""
+import argparse
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, delete, func, literal, select, true, union_all
+from sqlalchemy.orm import Session
+
+import models
+from models import Task, TaskArchive, TaskDailyStat, TaskEvent, TaskStageCount, dialect_insert, utcnow
+
+DOING = "Doing"
+DONE = "Done"
+
+
+def _upsert(conn, model, keys: List[str], counters: List[str], source=None):
+    """按主键累加计数列；MySQL 用 ON DUPLICATE KEY UPDATE，其余方言用 ON CONFLICT。
+    source 为 SELECT 时生成 INSERT ... SELECT，否则为多行 VALUES。"""
+    table = model.__table__
+    stmt = dialect_insert(conn, table)
+    if source is not None:
+        stmt = stmt.from_select(keys + counters, source)
+    if conn.dialect.name == "mysql":
+        return stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in counters})
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={c: table.c[c] + stmt.excluded[c] for c in counters},
+    )
+
+
+def _upsert_add(conn, model, keys: List[str], rows: List[dict]) -> None:
+    if not rows:
+        return
+    counters = [k for k in rows[0] if k not in keys]
+    conn.execute(_upsert(conn, model, keys, counters), rows)
+
+
+# ---------- 列计数：与任务写入同一事务 ----------
+
+_SIGNS = union_all(select(literal(-1).label("sign")), select(literal(1).label("sign"))).subquery("signs")
+
+
+def _task_conn(db: Session):
+    # 与任务表同库（分片时按会话绑定的用户路由），并处于会话当前事务中
+    return db.connection(bind_arguments={"mapper": Task.__mapper__})
+
+
+def add_stage(db: Session, user_id: int, stage: str) -> None:
+    """新建任务：所在列 +1。"""
+    conn = _task_conn(db)
+    conn.execute(_upsert(conn, TaskStageCount, ["user_id", "stage"], ["task_count"]),
+                 [{"user_id": user_id, "stage": stage, "task_count": 1}])
+
+
+def shift_stage(db: Session, conds: list, new_stage=None) -> None:
+    """在 UPDATE / DELETE 之前调用：conds 与随后语句的条件相同，命中的任务原列 -1、
+    new_stage 列 +1（new_stage 可以是基于 Task.column_name 的表达式；None 表示删除）。
+    一条 INSERT ... SELECT 完成，并锁住任务行直到提交；随后的写入未命中时调用方回滚即可。"""
+    if new_stage is None:
+        source = select(Task.user_id, Task.column_name, literal(-1)).where(*conds)
+    else:
+        source = (
+            select(
+                Task.user_id,
+                case((_SIGNS.c.sign < 0, Task.column_name), else_=new_stage),
+                _SIGNS.c.sign,
+            )
+            .select_from(Task.__table__.join(_SIGNS, true()))
+            .where(*conds, Task.column_name != new_stage)
+        )
+    conn = _task_conn(db)
+    conn.execute(_upsert(conn, TaskStageCount, ["user_id", "stage"], ["task_count"],
+                         source.with_for_update()))
+
+
+class Deltas:
+    def __init__(self):
+        self.stages: Dict[Tuple[int, str], int] = defaultdict(int)
+        self.daily: Dict[Tuple[int, date], Dict[str, int]] = defaultdict(
+            lambda: {"created": 0, "completed": 0, "doing_exits": 0, "doing_seconds": 0}
+        )
+
+    def apply(self, prev: Optional[dict], e: dict, track_stages: bool = True) -> None:
+        """根据同一任务的上一条事件 prev 计算事件 e 带来的变化，并补全 e["stage_since"]。"""
+        e.setdefault("stage_since", None)
+        uid = e["user_id"]
+        day = self.daily[(uid, e["occurred_at"].date())]
+        prev_stage = prev["stage"] if prev else None
+        if e["event_type"] == "created":
+            e["stage_since"] = e["occurred_at"]
+            if track_stages:
+                self.stages[(uid, e["stage"])] += 1
+            day["created"] += 1
+            if e["stage"] == DONE:
+                day["completed"] += 1
+            return
+        if prev is None:
+            # 没有历史（日志上线前创建的任务）：无法得知原列，留给重建修正
+            e["stage_since"] = e["occurred_at"] if e["stage"] else None
+            return
+        if e["event_type"] == "deleted":
+            if track_stages and prev_stage:
+                self.stages[(uid, prev_stage)] -= 1
+            return
+        if e["stage"] == prev_stage:
+            e["stage_since"] = prev.get("stage_since")
+            return
+        e["stage_since"] = e["occurred_at"]
+        if track_stages:
+            self.stages[(uid, prev_stage)] -= 1
+            self.stages[(uid, e["stage"])] += 1
+        if e["stage"] == DONE:
+            day["completed"] += 1
+        if prev_stage == DOING and prev.get("stage_since"):
+            day["doing_exits"] += 1
+            day["doing_seconds"] += int((e["occurred_at"] - prev["stage_since"]).total_seconds())
+
+    def write(self, conn, stages: bool = True) -> None:
+        if stages:
+            _upsert_add(conn, TaskStageCount, ["user_id", "stage"], [
+                {"user_id": uid, "stage": stage, "task_count": n}
+                for (uid, stage), n in self.stages.items() if n
+            ])
+        _upsert_add(conn, TaskDailyStat, ["user_id", "day"], [
+            dict(counters, user_id=uid, day=day)
+            for (uid, day), counters in self.daily.items() if any(counters.values())
+        ])
+
+
+def _latest_events(conn, events: List[dict]) -> Dict[Tuple[int, int], dict]:
+    task_ids = {e["task_id"] for e in events}
+    latest_ids = (
+        select(func.max(TaskEvent.id))
+        .where(TaskEvent.task_id.in_(task_ids))
+        .group_by(TaskEvent.task_id)
+    )
+    rows = conn.execute(
+        select(TaskEvent.user_id, TaskEvent.task_id, TaskEvent.stage, TaskEvent.stage_since)
+        .where(TaskEvent.id.in_(latest_ids))
+    ).mappings().all()
+    return {(r["user_id"], r["task_id"]): dict(r) for r in rows}
+
+
+def _event_order(e: dict):
+    # 同一任务按版本号排序（并发请求入队顺序可能与提交顺序不同），删除排在最后
+    return (e["task_id"], e["version"] if e["version"] is not None else float("inf"))
+
+
+def apply_events(conn, events: List[dict]) -> None:
+    """在写入一批事件之前调用（同一事务）：补全 stage_since 并累加按天统计。"""
+    prev = _latest_events(conn, events)
+    deltas = Deltas()
+    for e in sorted(events, key=_event_order):
+        key = (e["user_id"], e["task_id"])
+        deltas.apply(prev.get(key), e, track_stages=False)
+        prev[key] = e if e["event_type"] != "deleted" else None
+    deltas.write(conn, stages=False)
+
+
+def remove_tasks(conn, rows) -> None:
+    """任务离开热表（归档）时从列计数中扣除；rows 为 (user_id, stage)。"""
+    counts: Dict[Tuple[int, str], int] = defaultdict(int)
+    for user_id, stage in rows:
+        counts[(user_id, stage)] -= 1
+    _upsert_add(conn, TaskStageCount, ["user_id", "stage"], [
+        {"user_id": uid, "stage": stage, "task_count": n} for (uid, stage), n in counts.items()
+    ])
+
+
+def rebuild(bind, user_ids: Optional[Iterable[int]] = None, stages: bool = True) -> None:
+    """从 tasks / tasks_archive / task_events 重新计算汇总；user_ids 为空时处理全部用户，
+    stages=False 时只重算按天统计（列计数已随任务写入在事务内维护）。"""
+    users = None if user_ids is None else sorted(set(user_ids))
+
+    def only(stmt, model):
+        return stmt if users is None else stmt.where(model.user_id.in_(users))
+
+    deltas = Deltas()
+    logged = set()
+    with bind.connect() as conn:
+        if stages:
+            for r in conn.execute(only(
+                select(Task.user_id, Task.column_name, func.count()), Task
+            ).group_by(Task.user_id, Task.column_name)):
+                deltas.stages[(r[0], r[1])] = r[2]
+
+        prev: Dict[Tuple[int, int], Optional[dict]] = {}
+        stmt = only(select(
+            TaskEvent.user_id, TaskEvent.task_id, TaskEvent.event_type,
+            TaskEvent.stage, TaskEvent.version, TaskEvent.occurred_at,
+        ), TaskEvent).order_by(TaskEvent.task_id, TaskEvent.id)
+        for ev in conn.execution_options(yield_per=5000).execute(stmt).mappings():
+            e = dict(ev)
+            key = (e["user_id"], e["task_id"])
+            if e["event_type"] == "created":
+                logged.add(key)
+            deltas.apply(prev.get(key), e, track_stages=False)
+            prev[key] = e if e["event_type"] != "deleted" else None
+
+        # 日志上线前创建（或创建事件丢失）的任务：按创建时间与最后更新时间近似
+        for model in (Task, TaskArchive):
+            stmt = only(select(model.user_id, model.id, model.created_at, model.updated_at, model.completed), model)
+            for r in conn.execution_options(yield_per=5000).execute(stmt):
+                if (r.user_id, r.id) in logged:
+                    continue
+                if r.created_at:
+                    deltas.daily[(r.user_id, r.created_at.date())]["created"] += 1
+                if r.completed and r.updated_at:
+                    deltas.daily[(r.user_id, r.updated_at.date())]["completed"] += 1
+
+    with bind.begin() as conn:
+        if stages:
+            conn.execute(only(delete(TaskStageCount), TaskStageCount))
+        conn.execute(only(delete(TaskDailyStat), TaskDailyStat))
+        deltas.write(conn, stages=stages)
+
+
+def read_stats(db: Session, user_id: int, days: int) -> dict:
+    since = utcnow().date() - timedelta(days=days - 1)
+    columns = {"To Do": 0, "Doing": 0, "Done": 0}
+    for row in db.execute(select(TaskStageCount).where(TaskStageCount.user_id == user_id)).scalars():
+        columns[row.stage] = row.task_count
+    daily = db.execute(
+        select(TaskDailyStat)
+        .where(TaskDailyStat.user_id == user_id, TaskDailyStat.day >= since)
+        .order_by(TaskDailyStat.day)
+    ).scalars().all()
+    exits = sum(d.doing_exits for d in daily)
+    seconds = sum(d.doing_seconds for d in daily)
+    return {
+        "columns": columns,
+        "daily": [
+            {"date": d.day.isoformat(), "created": d.created, "completed": d.completed}
+            for d in daily
+        ],
+        "avgDoingSeconds": round(seconds / exits) if exits else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Board statistics rollups")
+    parser.add_argument("--rebuild", action="store_true", help="从任务与事件表重新计算统计汇总")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.print_help()
+        return
+    models.init_db()
+    for bind in [models.engine, *models.shard_engines]:
+        rebuild(bind)
+    print("rollups rebuilt")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,186 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Optional, Union, Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt, JWTError
-from passlib.context import CryptContext
 from pydantic import BaseModel, Field, EmailStr
-from sqlalchemy import select, or_
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from models import User, get_db
+from models import User, bind_user, get_db, mark_recent_write
 
 
 JWT_SECRET_KEY = "change-this-secret-in-prod"
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 REFRESH_TOKEN_EXPIRE_DAYS = 14
+# JWT 实现：jose（默认）或 pyjwt（更快，需安装 PyJWT）
+JWT_BACKEND = os.getenv("JWT_BACKEND", "jose")
+# 已验证 claims 的缓存：容量与最长缓存时间（同时不超过 exp）
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+
+# 不存在的登录标识（用户名/邮箱）的计数：同一标识在 TTL 内尝试超过 LOGIN_UNKNOWN_MAX_ATTEMPTS
+# 次返回 429，不再查库。未超限时仍查库：缓存是进程内的，用户可能刚在其他 worker 注册
+LOGIN_NEGATIVE_CACHE_SIZE = int(os.getenv("LOGIN_NEGATIVE_CACHE_SIZE", "10000"))
+LOGIN_NEGATIVE_TTL_SECONDS = int(os.getenv("LOGIN_NEGATIVE_TTL_SECONDS", "60"))
+LOGIN_UNKNOWN_MAX_ATTEMPTS = int(os.getenv("LOGIN_UNKNOWN_MAX_ATTEMPTS", "10"))
 
 router = APIRouter(tags=["auth"])
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
-# 密码哈希
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 密码哈希（passlib / bcrypt 在第一次使用时才导入，缩短 worker 启动时间）
+@lru_cache(maxsize=None)
+def _pwd_context():
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def hash_password(p: str) -> str:
-    return pwd_context.hash(p)
+    return _pwd_context().hash(p)
 
 def verify_password(p: str, h: str) -> bool:
-    return pwd_context.verify(p, h)
+    return _pwd_context().verify(p, h)
+
+# JWT 后端：返回 (encode, decode)，decode 失败返回 None
+def _jose_backend():
+    from jose import jwt, JWTError
+
+    def encode(payload: dict) -> str:
+        return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+    def decode(token: str) -> Optional[dict]:
+        try:
+            return jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        except JWTError:
+            return None
+
+    return encode, decode
+
+def _pyjwt_backend():
+    import jwt
+
+    def encode(payload: dict) -> str:
+        return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+    def decode(token: str) -> Optional[dict]:
+        try:
+            return jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        except jwt.PyJWTError:
+            return None
+
+    return encode, decode
+
+JWT_BACKENDS = {"jose": _jose_backend, "pyjwt": _pyjwt_backend}
+
+if JWT_BACKEND not in JWT_BACKENDS:
+    raise ValueError(f"Unknown JWT_BACKEND: {JWT_BACKEND}")
+
+# JWT 库同样延迟到第一次签发/校验时导入
+@lru_cache(maxsize=None)
+def _jwt_backend():
+    return JWT_BACKENDS[JWT_BACKEND]()
+
+def _jwt_encode(payload: dict) -> str:
+    return _jwt_backend()[0](payload)
+
+def _jwt_decode(token: str) -> Optional[dict]:
+    return _jwt_backend()[1](token)
+
+# 已验证 token 的 LRU/TTL 缓存，键为 token 的 SHA-256
+class TokenCache:
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE, ttl: int = TOKEN_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if time.time() >= expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return claims
+
+    def put(self, token: str, claims: dict) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if "exp" in claims:
+            expires_at = min(expires_at, float(claims["exp"]))
+        key = self._key(token)
+        with self._lock:
+            self._data[key] = (claims, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+token_cache = TokenCache()
+
+
+class UnknownLoginCache:
+    """记录查无此人的登录标识及其尝试次数（LRU + TTL）。"""
+
+    def __init__(self, maxsize: int = LOGIN_NEGATIVE_CACHE_SIZE, ttl: int = LOGIN_NEGATIVE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, identifier: str) -> Optional[int]:
+        """已缓存时累加并返回尝试次数，未缓存返回 None。"""
+        with self._lock:
+            entry = self._data.get(identifier)
+            if entry is None:
+                return None
+            if time.time() >= entry[1]:
+                del self._data[identifier]
+                return None
+            entry[0] += 1
+            self._data.move_to_end(identifier)
+            return entry[0]
+
+    def put(self, identifier: str) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[identifier] = [1, time.time() + self.ttl]
+            self._data.move_to_end(identifier)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, *identifiers: str) -> None:
+        with self._lock:
+            for identifier in identifiers:
+                self._data.pop(identifier, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+unknown_logins = UnknownLoginCache()
 
 # JWT
 def create_token(subject: Union[str, int], expires_delta: timedelta, token_type: str) -> str:
@@ -40,7 +192,7 @@ def create_token(subject: Union[str, int], expires_delta: timedelta, token_type:
         "iat": int(now.timestamp()),
         "exp": int(expire.timestamp()),
     }
-    return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+    return _jwt_encode(payload)
 
 def create_access_token(subject: Union[str, int]) -> str:
     return create_token(subject, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES), "access")
@@ -49,10 +201,13 @@ def create_refresh_token(subject: Union[str, int]) -> str:
     return create_token(subject, timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS), "refresh")
 
 def decode_token(token: str) -> Optional[dict]:
-    try:
-        return jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-    except JWTError:
-        return None
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    claims = _jwt_decode(token)
+    if claims is not None:
+        token_cache.put(token, claims)
+    return claims
 
 # ===== Pydantic 模型 =====
 class UserCreate(BaseModel):
@@ -84,6 +239,12 @@ class RefreshRequest(BaseModel):
     refresh_token: str
 
 
+# 每个鉴权请求都要按主键读取用户：语句只构造一次
+_USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
+# 登录按标识形态各走一个唯一索引，避免 OR 条件退化为 index_merge / 全表扫描
+_USER_BY_USERNAME = select(User).where(User.username == bindparam("username"))
+_USER_BY_EMAIL = select(User).where(User.email == bindparam("email"))
+
 def get_current_user(
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme),
@@ -92,31 +253,44 @@ def get_current_user(
     if not payload or "sub" not in payload or payload.get("type") != "access":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid access token")
     user_id = int(payload["sub"])
-    user = db.get(User, user_id)
+    bind_user(db, user_id)
+    user = db.execute(_USER_BY_ID, {"user_id": user_id}).scalar_one_or_none()
     if not user or user.status != 1:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User disabled or not found")
     return user
 
+def _violates_email_unique(e: IntegrityError) -> bool:
+    # 只看约束名/列名：MySQL 消息里带有重复的值本身（用户名可能含 "email"）
+    # MySQL: Duplicate entry '...' for key 'users.ix_users_email'；SQLite: UNIQUE constraint failed: users.email
+    msg = str(e.orig)
+    if "for key" in msg:
+        msg = msg.rpartition("for key")[2]
+    else:
+        msg = msg.rpartition("failed:")[2]
+    msg = msg.strip(" '\")").lower()
+    return msg in ("users.ix_users_email", "ix_users_email", "users.email")
+
 # 路由
 @router.post("/auth/register", response_model=TokenPair, summary="注册")
 def register(data: UserCreate, db: Session = Depends(get_db)):
-    existed = db.execute(
-        select(User).where(or_(User.username == data.username, User.email == data.email))
-    ).scalar_one_or_none()
-    if existed:
-        if existed.username == data.username:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already taken")
-        if existed.email == data.email:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
-
+    # 不做预查询，直接插入，由唯一索引判重
     user = User(
         username=data.username,
         email=data.email,
         password_hash=hash_password(data.password),
     )
     db.add(user)
+    try:
+        db.flush()
+    except IntegrityError as e:
+        db.rollback()
+        if _violates_email_unique(e):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already taken")
     db.commit()
-    db.refresh(user)
+    # 新用户紧接着会读取自身信息，先固定走主库
+    mark_recent_write(user.id)
+    unknown_logins.discard(data.username, data.email)
 
     access_token = create_access_token(user.id)
     refresh_token = create_refresh_token(user.id)
@@ -124,8 +298,22 @@ def register(data: UserCreate, db: Session = Depends(get_db)):
 
 @router.post("/auth/login", response_model=TokenPair, summary="登录（用户名或邮箱）")
 def login(data: UserLogin, db: Session = Depends(get_db)):
-    q = select(User).where(or_(User.username == data.username, User.email == data.username))
-    user = db.execute(q).scalar_one_or_none()
+    identifier = data.username
+    attempts = unknown_logins.hit(identifier)
+    if attempts is not None and attempts > LOGIN_UNKNOWN_MAX_ATTEMPTS:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many login attempts")
+
+    user = None
+    if "@" in identifier:
+        user = db.execute(_USER_BY_EMAIL, {"email": identifier}).scalar_one_or_none()
+    # 用户名本身可能含 @，邮箱查不到时再按用户名查一次
+    if user is None:
+        user = db.execute(_USER_BY_USERNAME, {"username": identifier}).scalar_one_or_none()
+    if user is None:
+        if attempts is None:
+            unknown_logins.put(identifier)
+    elif attempts is not None:
+        unknown_logins.discard(identifier)
     if not user or user.status != 1 or not verify_password(data.password, user.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
@@ -140,7 +328,7 @@ def refresh_tokens(req: RefreshRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
 
     user_id = int(payload["sub"])
-    user = db.get(User, user_id)
+    user = db.execute(_USER_BY_ID, {"user_id": user_id}).scalar_one_or_none()
     if not user or user.status != 1:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User disabled or not found")
 
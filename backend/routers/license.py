@@ -2,12 +2,15 @@ from datetime import datetime, timezone
 import re
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, status
+from fastapi import APIRouter, Depends, Header, HTTPException, UploadFile, File, status
 from pydantic import BaseModel
-from sqlalchemy import select
+from sqlalchemy import bindparam, select
 from sqlalchemy.orm import Session
 
-from models import get_db, User, LicenseKey, UserLicense, hash_license_key
+from models import get_db, User, LicenseKey, UserLicense, EntitlementState, hash_license_key
+from entitlements import entitlement_sweeper, record_activation
+from bloom import license_filter
+from idempotency import idempotency_store
 from routers.auth import get_current_user  
 
 router = APIRouter(prefix="/license", tags=["license"])
@@ -25,54 +28,60 @@ class ActivateByKey(BaseModel):
 def _now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
+# 激活热路径：按 key_hash 查询的语句只构造一次
+_LICENSE_BY_HASH = select(LicenseKey).where(LicenseKey.key_hash == bindparam("key_hash"))
+
 def _find_license_by_raw_key(db: Session, raw_key: str) -> Optional[LicenseKey]:
     key_norm = raw_key.strip().upper()
     if not LICENSE_KEY_REGEX.match(key_norm):
         return None
     kh = hash_license_key(key_norm)
-    stmt = select(LicenseKey).where(LicenseKey.key_hash == kh)
-    return db.execute(stmt).scalar_one_or_none()
-
-def _user_already_licensed(db: Session, user_id: int) -> Optional[UserLicense]:
-    stmt = (
-        select(UserLicense)
-        .join(LicenseKey, LicenseKey.id == UserLicense.license_key_id)
-        .where(UserLicense.user_id == user_id)
-        .order_by(UserLicense.activated_at.desc())
-    )
-    return db.execute(stmt).scalars().first()
+    # 布隆过滤器判定不存在则直接返回，不查库
+    if not license_filter.might_exist(kh):
+        return None
+    lk = db.execute(_LICENSE_BY_HASH, {"key_hash": kh}).scalar_one_or_none()
+    if lk is None:
+        license_filter.record_false_positive()
+    return lk
+
+def _is_active(ent: Optional[EntitlementState]) -> bool:
+    # 清扫器尚未处理的到期也视为失效
+    if not ent or not ent.licensed:
+        return False
+    return not ent.valid_until or ent.valid_until.replace(tzinfo=timezone.utc) >= _now_utc()
 
 @router.get("/status", response_model=LicenseStatus, summary="查询当前用户许可状态")
 def license_status(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    ul = _user_already_licensed(db, current_user.id)
-    if not ul:
-        return LicenseStatus(licensed=False)
-
-    lk = ul.license_key
-    if lk.expires_at and lk.expires_at.replace(tzinfo=timezone.utc) < _now_utc():
+    ent = db.get(EntitlementState, current_user.id)
+    if not _is_active(ent):
         return LicenseStatus(licensed=False)
 
     return LicenseStatus(
         licensed=True,
-        expires_at=lk.expires_at,
-        feature=lk.feature,
+        expires_at=ent.valid_until,
+        feature=ent.feature,
     )
 
 @router.post("/activate", response_model=LicenseStatus, summary="使用密钥激活")
 def activate_license(
     payload: ActivateByKey,
+    idempotency_key: Optional[str] = Header(default=None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
+    return idempotency_store.run(
+        current_user.id, "license.activate", idempotency_key, payload,
+        lambda: _activate_license(payload, current_user, db), db=db,
+    )
+
+def _activate_license(payload: ActivateByKey, current_user: User, db: Session):
     key_input = payload.key.strip().upper()
     if not LICENSE_KEY_REGEX.match(key_input):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid key format")
 
-    ul = _user_already_licensed(db, current_user.id)
-    if ul:
-        lk = ul.license_key
-        if not lk.expires_at or lk.expires_at.replace(tzinfo=timezone.utc) >= _now_utc():
-            return LicenseStatus(licensed=True, expires_at=lk.expires_at, feature=lk.feature)
+    ent = db.get(EntitlementState, current_user.id)
+    if _is_active(ent):
+        return LicenseStatus(licensed=True, expires_at=ent.valid_until, feature=ent.feature)
 
     lk = _find_license_by_raw_key(db, key_input)
     if not lk:
@@ -90,9 +99,9 @@ def activate_license(
 
     ul_new = UserLicense(user_id=current_user.id, license_key_id=lk.id, feature=lk.feature)
     db.add(ul_new)
+    record_activation(db, current_user.id, lk.feature, lk.expires_at)
     db.commit()
-    db.refresh(ul_new)
-    db.refresh(lk)
+    entitlement_sweeper.schedule(lk.expires_at)
 
     return LicenseStatus(licensed=True, expires_at=lk.expires_at, feature=lk.feature)
 
@@ -110,4 +119,4 @@ async def activate_license_file(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="License file invalid")
     key_input = match.group(0)
     payload = ActivateByKey(key=key_input)
-    return activate_license(payload, current_user=current_user, db=db)
\ No newline at end of file
+    return activate_license(payload, idempotency_key=None, current_user=current_user, db=db)
\ No newline at end of file
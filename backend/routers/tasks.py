@@ -1,12 +1,15 @@
 from datetime import timezone
 from typing import Optional, Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
 from pydantic import BaseModel, Field
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, update, delete, case, bindparam
 from sqlalchemy.orm import Session
 
-from models import Task, get_db
+from models import Task, TaskArchive, get_db
+from activity import activity_log
+from idempotency import idempotency_store
+from rollups import add_stage, read_stats, shift_stage
 from routers.auth import get_current_user, oauth2_scheme  # 若与 main.py 同项目根目录，请确保可导入
 
 router = APIRouter(prefix="/api/v1/tasks", tags=["Tasks"])
@@ -50,8 +53,27 @@ def task_to_dict(t: Task) -> dict:
         "completed": bool(t.completed),
         "createdAt": to_iso(t.created_at),
         "updatedAt": to_iso(t.updated_at),
+        "version": t.version,
     }
 
+# 工具：ETag 使用版本号
+def etag_for(t: Task) -> str:
+    return f'"{t.version}"'
+
+# 工具：解析 If-Match，支持 "3"、W/"3"；* 或未提供时返回 None（不校验版本）
+def parse_if_match(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    v = value.strip()
+    if v == "*":
+        return None
+    if v.startswith("W/"):
+        v = v[2:]
+    v = v.strip('"')
+    if not v.isdigit():
+        err("Validation error", "VALIDATION_ERROR", details={"If-Match": "Invalid ETag"}, http_status=400)
+    return int(v)
+
 # 请求
 class TaskCreate(BaseModel):
     title: str = Field(..., min_length=1, max_length=255)
@@ -63,9 +85,11 @@ class TaskUpdate(BaseModel):
     description: Optional[str] = None
     column: Optional[str] = None
     completed: Optional[bool] = None
+    version: Optional[int] = None
 
 class MoveRequest(BaseModel):
     column: str = Field(...)
+    version: Optional[int] = None
 
 def normalize_column(col: Optional[str]) -> str:
     if not col:
@@ -84,49 +108,142 @@ def normalize_title(title: Optional[str]) -> Optional[str]:
     return t
 
 # 获取任务
+# 热路径查询：模块加载时构造一次，调用时只绑定参数，省去每次构造 select() 与生成缓存键
+_TASK_BY_ID = select(Task).where(Task.id == bindparam("task_id"), Task.user_id == bindparam("user_id"))
+
+def _list_tasks_stmt(by_completed: bool, by_column: bool):
+    filters = [Task.user_id == bindparam("user_id")]
+    if by_completed:
+        filters.append(Task.completed == bindparam("completed"))
+    if by_column:
+        filters.append(Task.column_name == bindparam("column"))
+    return select(Task).where(and_(*filters)).order_by(Task.created_at.desc())
+
+# 可选过滤条件的四种组合：(按 completed, 按列) -> 语句
+_LIST_TASKS = {(c, col): _list_tasks_stmt(c, col) for c in (False, True) for col in (False, True)}
+_LIST_ARCHIVED = (
+    select(TaskArchive)
+    .where(TaskArchive.user_id == bindparam("user_id"))
+    .order_by(TaskArchive.created_at.desc())
+)
+
 def get_task_or_404(db: Session, user_id: int, task_id: int) -> Task:
-    task = db.get(Task, task_id)
-    if not task or task.user_id != user_id:
+    task = db.execute(_TASK_BY_ID, {"task_id": task_id, "user_id": user_id}).scalar_one_or_none()
+    if task is None:
         err("Task not found", "TASK_NOT_FOUND", http_status=404)
     return task
 
+# 单条 UPDATE ... WHERE id AND user_id [AND version] 完成写入，不再先 SELECT
+# If-Match 不匹配 -> 412；请求体 version 不匹配 -> 409
+def apply_task_update(
+    db: Session,
+    user_id: int,
+    task_id: int,
+    values: list,
+    if_match: Optional[str] = None,
+    version: Optional[int] = None,
+    new_stage=None,
+) -> Task:
+    expected = parse_if_match(if_match)
+    conds = [Task.id == task_id, Task.user_id == user_id]
+    if expected is not None:
+        conds.append(Task.version == expected)
+    if version is not None:
+        conds.append(Task.version == version)
+    # 换列时在同一事务内先调整列计数（并锁住该行）
+    if new_stage is not None:
+        shift_stage(db, conds, new_stage)
+    stmt = (
+        update(Task)
+        .where(*conds)
+        .ordered_values(*values, (Task.version, Task.version + 1))
+        .execution_options(synchronize_session=False)
+    )
+    # 支持 RETURNING 的方言一次往返取回新行；MySQL 退化为按主键读取
+    if db.get_bind(Task.__mapper__).dialect.update_returning:
+        t = db.execute(stmt.returning(Task)).scalar_one_or_none()
+        if t is None:
+            db.rollback()
+            raise_update_conflict(db, user_id, task_id, expected)
+        return t
+    result = db.execute(stmt)
+    if result.rowcount == 0:
+        db.rollback()
+        raise_update_conflict(db, user_id, task_id, expected)
+    return db.execute(_TASK_BY_ID, {"task_id": task_id, "user_id": user_id}).scalar_one()
+
+# 写入未命中时才查询一次，区分 404 / 412 / 409
+def raise_update_conflict(db: Session, user_id: int, task_id: int, expected: Optional[int]):
+    current = db.execute(
+        select(Task.version).where(Task.id == task_id, Task.user_id == user_id)
+    ).scalar_one_or_none()
+    if current is None:
+        err("Task not found", "TASK_NOT_FOUND", http_status=404)
+    if expected is not None and current != expected:
+        err("Precondition failed", "PRECONDITION_FAILED", details={"version": current}, http_status=412)
+    err("Version conflict", "VERSION_CONFLICT", details={"version": current}, http_status=409)
+
 # 1) GET /api/v1/tasks
 @router.get("")
 def list_tasks(
     completed: Optional[bool] = Query(default=None),
     column: Optional[str] = Query(default=None),
+    include_archived: bool = Query(default=False),
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    filters = [Task.user_id == current_user.id]
-    if completed is not None:
-        filters.append(Task.completed == completed)
-    if column is not None:
-        if column not in COLUMNS:
-            err("Validation error", "VALIDATION_ERROR", details={"column": "Column must be 'To Do' | 'Doing' | 'Done'"}, http_status=400)
-        filters.append(Task.column_name == column)
-    q = select(Task).where(and_(*filters)).order_by(Task.created_at.desc())
-    rows = db.execute(q).scalars().all()
+    if column is not None and column not in COLUMNS:
+        err("Validation error", "VALIDATION_ERROR", details={"column": "Column must be 'To Do' | 'Doing' | 'Done'"}, http_status=400)
+    q = _LIST_TASKS[(completed is not None, column is not None)]
+    params = {"user_id": current_user.id, "completed": completed, "column": column}
+    rows = db.execute(q, {k: v for k, v in params.items() if v is not None}).scalars().all()
     data = [task_to_dict(t) for t in rows]
+    # 归档表仅在显式请求时读取（归档任务均为已完成）
+    if include_archived and completed is not False and column in (None, "Done"):
+        rows = db.execute(_LIST_ARCHIVED, {"user_id": current_user.id}).scalars().all()
+        archived = [dict(task_to_dict(t), archived=True) for t in rows]
+        data = sorted(data + archived, key=lambda d: d["createdAt"] or "", reverse=True)
     return ok(data=data, count=len(data))
 
+# GET /api/v1/tasks/stats（须在 /{task_id} 之前注册）
+@router.get("/stats")
+def task_stats(
+    days: int = Query(default=30, ge=1, le=366),
+    db: Session = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    # 读取增量维护的汇总表，代价与天数相关而与任务数无关
+    return ok(data=read_stats(db, current_user.id, days))
+
 # 2) GET /api/v1/tasks/:id
 @router.get("/{task_id}")
 def get_task(
     task_id: int,
+    response: Response,
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
     t = get_task_or_404(db, current_user.id, task_id)
+    response.headers["ETag"] = etag_for(t)
     return ok(data=task_to_dict(t))
 
 # 3) POST /api/v1/tasks
 @router.post("", status_code=status.HTTP_201_CREATED)
 def create_task(
     payload: TaskCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
+    # 带 Idempotency-Key 的重试直接重放首次的响应
+    return idempotency_store.run(
+        current_user.id, "tasks.create", idempotency_key, payload,
+        lambda: _create_task(payload, response, db, current_user),
+        response, status.HTTP_201_CREATED, db=db,
+    )
+
+def _create_task(payload: TaskCreate, response: Response, db: Session, current_user):
     title = normalize_title(payload.title)
     column = normalize_column(payload.column)
     # 规则：列为 Done -> completed=true，否则 false
@@ -140,8 +257,10 @@ def create_task(
         completed=completed,
     )
     db.add(t)
+    add_stage(db, current_user.id, column)
     db.commit()
-    db.refresh(t)
+    activity_log.record_task("created", t)
+    response.headers["ETag"] = etag_for(t)
     return ok(message="Task created successfully", data=task_to_dict(t))
 
 # 4) PATCH /api/v1/tasks/:id
@@ -149,11 +268,11 @@ def create_task(
 def update_task(
     task_id: int,
     payload: TaskUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    t = get_task_or_404(db, current_user.id, task_id)
-
     has_any = any([
         payload.title is not None,
         payload.description is not None,
@@ -163,68 +282,89 @@ def update_task(
     if not has_any:
         err("Validation error", "VALIDATION_ERROR", details={"_": "At least one field must be provided"}, http_status=400)
 
+    values = []
+    column = None
     if payload.title is not None:
-        t.title = normalize_title(payload.title)
+        values.append((Task.title, normalize_title(payload.title)))
     if payload.description is not None:
-        t.description = payload.description.strip() if payload.description is not None else None
+        values.append((Task.description, payload.description.strip()))
     if payload.column is not None:
-        t.column_name = normalize_column(payload.column)
+        column = normalize_column(payload.column)
         # 列变化时同步 completed
-        t.completed = (t.column_name == "Done")
-    if payload.completed is not None:
+        values.append((Task.completed, column == "Done"))
+        values.append((Task.column_name, column))
+    elif payload.completed is not None:
         # 若明确传 completed，也需与业务一致：当列为 Done，completed 必须 true；非 Done 必须 false
-        if t.column_name == "Done":
-            t.completed = True
-        else:
-            t.completed = False
+        values.append((Task.completed, case((Task.column_name == "Done", True), else_=False)))
 
+    t = apply_task_update(db, current_user.id, task_id, values, if_match=if_match, version=payload.version,
+                          new_stage=column)
+    data = task_to_dict(t)
     db.commit()
-    db.refresh(t)
-    return ok(message="Task updated successfully", data=task_to_dict(t))
+    activity_log.record_task("updated", t)
+    response.headers["ETag"] = etag_for(t)
+    return ok(message="Task updated successfully", data=data)
 
 # 5) DELETE /api/v1/tasks/:id
 @router.delete("/{task_id}")
 def delete_task(
     task_id: int,
+    if_match: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    t = get_task_or_404(db, current_user.id, task_id)
-    db.delete(t)
+    expected = parse_if_match(if_match)
+    conds = [Task.id == task_id, Task.user_id == current_user.id]
+    if expected is not None:
+        conds.append(Task.version == expected)
+    shift_stage(db, conds)
+    result = db.execute(delete(Task).where(*conds).execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        db.rollback()
+        raise_update_conflict(db, current_user.id, task_id, expected)
     db.commit()
+    activity_log.record(current_user.id, task_id, "deleted")
     return ok(message="Task deleted successfully")
 
 # 6) PATCH /api/v1/tasks/:id/toggle
 @router.patch("/{task_id}/toggle")
 def toggle_task(
     task_id: int,
+    response: Response,
+    if_match: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    t = get_task_or_404(db, current_user.id, task_id)
     # 规则：在 Done 与 To Do 之间切换；如果当前 Doing，则切到 Done
-    if t.column_name == "Done":
-        t.column_name = "To Do"
-        t.completed = False
-    else:
-        t.column_name = "Done"
-        t.completed = True
+    # completed 须排在 stage 之前赋值（MySQL 按从左到右使用新值）
+    new_stage = case((Task.column_name == "Done", "To Do"), else_="Done")
+    values = [
+        (Task.completed, case((Task.column_name == "Done", False), else_=True)),
+        (Task.column_name, new_stage),
+    ]
+    t = apply_task_update(db, current_user.id, task_id, values, if_match=if_match, new_stage=new_stage)
+    data = task_to_dict(t)
     db.commit()
-    db.refresh(t)
-    return ok(message="Task status updated", data=task_to_dict(t))
+    activity_log.record_task("toggled", t)
+    response.headers["ETag"] = etag_for(t)
+    return ok(message="Task status updated", data=data)
 
 # 7) PATCH /api/v1/tasks/:id/move
 @router.patch("/{task_id}/move")
 def move_task(
     task_id: int,
     payload: MoveRequest,
+    response: Response,
+    if_match: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    t = get_task_or_404(db, current_user.id, task_id)
     target = normalize_column(payload.column)
-    t.column_name = target
-    t.completed = (target == "Done")
+    values = [(Task.completed, target == "Done"), (Task.column_name, target)]
+    t = apply_task_update(db, current_user.id, task_id, values, if_match=if_match, version=payload.version,
+                          new_stage=target)
+    data = task_to_dict(t)
     db.commit()
-    db.refresh(t)
-    return ok(message="Task moved successfully", data=task_to_dict(t))
\ No newline at end of file
+    activity_log.record_task("moved", t)
+    response.headers["ETag"] = etag_for(t)
+    return ok(message="Task moved successfully", data=data)
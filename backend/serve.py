@@ -0,0 +1,152 @@
+"""
+生产环境启动入口：多 worker 进程运行 main:app。
+
+- 安装了 gunicorn 时：主进程预加载应用（preload）后 fork 出 worker，代码与只读数据
+  以写时复制方式共享；worker 使用 UvicornWorker（uvloop / httptools 可用时自动启用），
+  处理 SERVE_MAX_REQUESTS 个请求后（加随机抖动）自动重启，fork 后丢弃继承的连接池；
+- 许可密钥布隆过滤器在主进程预加载时构建一次，worker 继承后只做增量拉取；
+- 归档、授权清扫等单实例任务由抢到锁的 worker 运行（见 leader.py）；
+- worker 的连接统一设置 TCP_NODELAY（见 NoDelayHTTPProtocol）；
+- 未安装 gunicorn 时退回 uvicorn 自带的多进程模式（各 worker 独立导入，无预加载）。
+
+同步路由的线程池大小由 THREADPOOL_SIZE 控制（见 main.py）。
+
+用法：
+    python serve.py                       # worker 数默认等于 CPU 核数
+    python serve.py --workers 4 --port 8000
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+
+from uvicorn.protocols.http.auto import AutoHTTPProtocol
+
+SERVE_HOST = os.getenv("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "8000"))
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0")) or os.cpu_count() or 1
+SERVE_MAX_REQUESTS = int(os.getenv("SERVE_MAX_REQUESTS", "10000"))
+SERVE_MAX_REQUESTS_JITTER = int(os.getenv("SERVE_MAX_REQUESTS_JITTER", "1000"))
+SERVE_KEEPALIVE = int(os.getenv("SERVE_KEEPALIVE", "5"))
+SERVE_TIMEOUT = int(os.getenv("SERVE_TIMEOUT", "60"))
+# 启动前在主进程建表/补列；表结构由发布流程维护时可关闭以加快启动
+SERVE_INIT_DB = os.getenv("SERVE_INIT_DB", "1") == "1"
+
+APP = "main:app"
+
+
+class NoDelayHTTPProtocol(AutoHTTPProtocol):
+    """多进程模式下 worker 从共享描述符重建的监听套接字 proto 为 0，asyncio 不会为
+    新连接设置 TCP_NODELAY，keep-alive 连接上的响应会被 Nagle 与延迟确认拖慢约 40ms。"""
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().connection_made(transport)
+
+
+def _uvicorn_worker_class():
+    # uvicorn 新版本把 gunicorn worker 移到了独立的 uvicorn-worker 包
+    try:
+        from uvicorn_worker import UvicornWorker
+    except ImportError:
+        from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = dict(UvicornWorker.CONFIG_KWARGS, http=NoDelayHTTPProtocol)
+
+    return Worker
+
+
+def _post_fork(server, worker) -> None:
+    import models
+
+    models.dispose_engines()
+
+
+def run_gunicorn(args) -> None:
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{args.host}:{args.port}",
+                "workers": args.workers,
+                "worker_class": _uvicorn_worker_class(),
+                "preload_app": True,
+                "max_requests": args.max_requests,
+                "max_requests_jitter": args.max_requests_jitter if args.max_requests else 0,
+                "keepalive": args.keepalive,
+                "timeout": args.timeout,
+                "graceful_timeout": args.timeout,
+                "post_fork": _post_fork,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from main import app
+            from bloom import LICENSE_FILTER_ENABLED, license_filter
+
+            if LICENSE_FILTER_ENABLED:
+                try:
+                    license_filter.build()
+                except Exception:
+                    # 构建失败时各 worker 启动后自行构建
+                    logging.getLogger("serve").exception("license filter prebuild failed")
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(args) -> None:
+    import uvicorn
+
+    uvicorn.run(
+        APP,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="auto",
+        http="serve:NoDelayHTTPProtocol",
+        timeout_keep_alive=args.keepalive,
+        limit_max_requests=args.max_requests or None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with multiple worker processes")
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS)
+    parser.add_argument("--max-requests", type=int, default=SERVE_MAX_REQUESTS, help="worker 处理多少请求后重启，0 表示不重启")
+    parser.add_argument("--max-requests-jitter", type=int, default=SERVE_MAX_REQUESTS_JITTER)
+    parser.add_argument("--keepalive", type=int, default=SERVE_KEEPALIVE)
+    parser.add_argument("--timeout", type=int, default=SERVE_TIMEOUT)
+    parser.add_argument("--no-init-db", dest="init_db", action="store_false", default=SERVE_INIT_DB,
+                        help="启动时不建表")
+    parser.add_argument("--no-gunicorn", action="store_true", help="强制使用 uvicorn 多进程模式")
+    args = parser.parse_args()
+
+    # 保证从任意目录启动都能导入 main / models
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # 主进程建表一次，worker 启动时跳过
+    if args.init_db:
+        import models
+
+        models.init_db()
+    os.environ["INIT_DB_ON_STARTUP"] = "0"
+    try:
+        if args.no_gunicorn:
+            raise ImportError
+        import gunicorn  # noqa: F401
+    except ImportError:
+        run_uvicorn(args)
+    else:
+        run_gunicorn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import random
+import string
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# 进程内测试使用临时 SQLite 库；需在导入 models 之前设置
+_DB_DIR = tempfile.mkdtemp(prefix="kanban-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_DB_DIR}/primary.db")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+PASSWORD = "P@ssw0rd123"
+
+
+def rand_str(prefix="u", n=8):
+    return prefix + "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
+
+
+def register(client, username=None, email=None):
+    username = username or rand_str("user_")
+    return client.post(
+        "/auth/register",
+        json={"username": username, "email": email or f"{username}@example.com", "password": PASSWORD},
+    )
+
+
+def auth_headers(client) -> dict:
+    """注册一个新用户，返回 Bearer 头。"""
+    r = register(client)
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+@pytest.fixture(scope="module")
+def client():
+    # 延迟导入：DATABASE_URL 须先于 main / models 设置
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture
+def auth(client):
+    return auth_headers(client)
@@ -0,0 +1,108 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, select
+
+import main
+import models
+import rollups
+from activity import ActivityLog
+from conftest import auth_headers
+
+
+def test_task_history_written_on_shutdown_drain():
+    with TestClient(main.app) as client:
+        headers = auth_headers(client)
+        t = client.post("/api/v1/tasks", headers=headers, json={"title": "history"}).json()["data"]
+        client.patch(f"/api/v1/tasks/{t['id']}/move", headers=headers, json={"column": "Doing"})
+        client.patch(f"/api/v1/tasks/{t['id']}/toggle", headers=headers)
+        client.delete(f"/api/v1/tasks/{t['id']}", headers=headers)
+    # 关闭时排空队列
+
+    with models.engine.connect() as conn:
+        rows = conn.execute(
+            select(models.TaskEvent.event_type, models.TaskEvent.stage, models.TaskEvent.version)
+            .where(models.TaskEvent.task_id == int(t["id"]))
+            .order_by(models.TaskEvent.id)
+        ).all()
+    assert [tuple(r) for r in rows] == [
+        ("created", "To Do", 1),
+        ("moved", "Doing", 2),
+        ("toggled", "Done", 3),
+        ("deleted", None, None),
+    ]
+
+
+def test_batches_are_multi_row_inserts():
+    models.init_db()
+    log = ActivityLog(flush_size=50, flush_interval=60)
+    inserts = []
+
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO task_events"):
+            inserts.append(executemany or statement.count("(?") > 1)
+
+    event.listen(models.engine, "before_cursor_execute", _before)
+    log.start()
+    try:
+        for i in range(120):
+            log.record(1, 10_000 + i, "created", "To Do", False, 1)
+        log.stop()
+    finally:
+        event.remove(models.engine, "before_cursor_execute", _before)
+    assert log.stats["written"] == 120
+    assert 3 <= log.stats["flushes"] <= 4
+    assert inserts and all(inserts)
+
+
+@pytest.mark.parametrize("overflow", ["drop", "block"])
+def test_full_queue_is_counted(overflow):
+    log = ActivityLog(maxsize=2, overflow=overflow, block_timeout=0.01)
+    for i in range(5):
+        log.record(1, i, "created")
+    stats = log.snapshot()
+    assert stats["enqueued"] == 2 and stats["dropped"] == 3 and stats["queued"] == 2
+    if overflow == "block":
+        assert stats["blocked"] == 3
+
+
+def log_event(task_id):
+    return {
+        "user_id": 1, "task_id": task_id, "event_type": "created", "stage": "To Do", "completed": False,
+        "version": 1, "occurred_at": models.utcnow(), "stage_since": None,
+    }
+
+
+def test_failed_batch_is_retried_before_dropping(monkeypatch):
+    models.init_db()
+    apply_events = rollups.apply_events
+    failures = []
+
+    def flaky(conn, rows):
+        if len(failures) < 2:
+            failures.append(1)
+            raise RuntimeError("database went away")
+        apply_events(conn, rows)
+
+    monkeypatch.setattr(rollups, "apply_events", flaky)
+    log = ActivityLog(retry_attempts=3, retry_backoff=0.01)
+    log.flush([log_event(20_001)])
+    assert (log.stats["written"], log.stats["retries"], log.stats["write_errors"]) == (1, 2, 0)
+
+    # 重试耗尽才丢弃，并把用户记为待修复
+    failures.clear()
+    log = ActivityLog(retry_attempts=2, retry_backoff=0.01)
+    log.flush([log_event(20_002)])
+    assert (log.stats["written"], log.stats["retries"], log.stats["write_errors"]) == (0, 1, 1)
+    assert log._dirty == {1}
+
+
+def test_stats_logged_with_warning_on_new_losses(caplog):
+    log = ActivityLog(maxsize=1)
+    with caplog.at_level("INFO", logger="activity"):
+        log.log_stats()
+        log.record(1, 1, "created")
+        log.record(1, 2, "created")
+        log.log_stats()
+        log.log_stats()
+    assert [r.levelname for r in caplog.records] == ["INFO", "WARNING", "INFO"]
+    assert "'dropped': 1" in caplog.records[1].getMessage()
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from sqlalchemy import select, update
+
+import archive
+import models
+from conftest import rand_str
+
+
+def test_archive_moves_old_completed_tasks(client, auth):
+    ids = []
+    for column in ("Done", "Done", "Done", "To Do"):
+        r = client.post("/api/v1/tasks", headers=auth, json={"title": rand_str("t_"), "column": column})
+        ids.append(int(r.json()["data"]["id"]))
+
+    # 前两个已完成任务“很久以前”完成；第三个刚完成；第四个未完成
+    old = models.utcnow() - timedelta(days=120)
+    with models.engine.begin() as conn:
+        conn.execute(update(models.Task).where(models.Task.id.in_(ids[:2] + ids[3:])).values(updated_at=old))
+
+    moved = archive.archive_completed_tasks(older_than_days=90, batch_size=1, pause=0)
+    assert moved >= 2
+
+    with models.engine.connect() as conn:
+        hot = set(conn.execute(select(models.Task.id).where(models.Task.id.in_(ids))).scalars())
+        cold = set(conn.execute(select(models.TaskArchive.id).where(models.TaskArchive.id.in_(ids))).scalars())
+    assert hot == {ids[2], ids[3]}
+    assert cold == {ids[0], ids[1]}
+
+    r = client.get("/api/v1/tasks", headers=auth)
+    assert r.json()["count"] == 2
+
+    r = client.get("/api/v1/tasks", headers=auth, params={"include_archived": "true"})
+    data = r.json()["data"]
+    assert len(data) == 4
+    assert sum(1 for t in data if t.get("archived")) == 2
+
+    r = client.get("/api/v1/tasks", headers=auth, params={"include_archived": "true", "completed": "false"})
+    assert r.json()["count"] == 1
+
+
+def test_task_uncompleted_after_selection_stays_on_board(client, auth, monkeypatch):
+    ids = []
+    for _ in range(2):
+        r = client.post("/api/v1/tasks", headers=auth, json={"title": rand_str("t_"), "column": "Done"})
+        ids.append(int(r.json()["data"]["id"]))
+    old = models.utcnow() - timedelta(days=120)
+    with models.engine.begin() as conn:
+        conn.execute(update(models.Task).where(models.Task.id.in_(ids)).values(updated_at=old))
+
+    # 候选查询之后、迁移之前，第二个任务被移回 Doing（取消完成）
+    lock_candidates = archive._lock_candidates
+
+    def racing(conn, cutoff, batch_size):
+        found = lock_candidates(conn, cutoff, batch_size)
+        conn.execute(update(models.Task).where(models.Task.id == ids[1]).values(
+            completed=False, column_name="Doing", updated_at=models.utcnow()))
+        return found
+
+    removed = []
+    remove_tasks = archive.rollups.remove_tasks
+    monkeypatch.setattr(archive, "_lock_candidates", racing)
+    monkeypatch.setattr(archive.rollups, "remove_tasks", lambda conn, rows: (removed.extend(rows), remove_tasks(conn, rows)))
+    archive.archive_completed_tasks(older_than_days=90, batch_size=100, pause=0)
+
+    with models.engine.connect() as conn:
+        hot = set(conn.execute(select(models.Task.id).where(models.Task.id.in_(ids))).scalars())
+        cold = set(conn.execute(select(models.TaskArchive.id).where(models.TaskArchive.id.in_(ids))).scalars())
+    assert hot == {ids[1]}
+    assert cold == {ids[0]}
+
+    # 列计数只扣减真正迁走的任务
+    assert [stage for _, stage in removed] == ["Done"]
+    r = client.get("/api/v1/tasks", headers=auth)
+    assert [t["id"] for t in r.json()["data"]] == [str(ids[1])]
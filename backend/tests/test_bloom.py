@@ -0,0 +1,135 @@
+import hashlib
+import random
+import string
+import sys
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, func, select
+
+import main
+import models
+from bloom import BloomFilter, LicenseKeyFilter, license_filter
+
+
+def h(i) -> str:
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+def test_false_positive_rate_close_to_target():
+    bf = BloomFilter(capacity=10_000, fp_rate=0.01)
+    for i in range(10_000):
+        bf.add(h(i))
+    assert all(h(i) in bf for i in range(10_000))
+    fp = sum(h(f"x{i}") in bf for i in range(20_000)) / 20_000
+    assert fp < 0.02
+
+
+def test_memory_budget_caps_size():
+    bf = BloomFilter(capacity=10_000_000, fp_rate=0.0001, max_bytes=1024)
+    assert len(bf.bits) <= 1024
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        deadline = time.time() + 5
+        while not license_filter.ready and time.time() < deadline:
+            time.sleep(0.05)
+        yield c
+
+
+def test_unknown_key_rejected_without_key_query(client, auth):
+    statements = []
+    listener = lambda *a: statements.append(a[2])  # noqa: E731
+    event.listen(models.engine, "before_cursor_execute", listener)
+    try:
+        # 第一次判定不存在会触发一次限频的增量拉取；之后的请求不再访问 license_keys
+        client.post("/license/activate", headers=auth, json={"key": "ZZZZ-ZZZZ-ZZZZ-0000"})
+        statements.clear()
+        before = license_filter.snapshot()["lookups_avoided"]
+        r = client.post("/license/activate", headers=auth, json={"key": "ZZZZ-ZZZZ-ZZZZ-0001"})
+    finally:
+        event.remove(models.engine, "before_cursor_execute", listener)
+
+    assert r.status_code == 404
+    assert not any("license_keys" in s for s in statements), statements
+    assert license_filter.snapshot()["lookups_avoided"] == before + 1
+
+
+def test_new_key_found_by_tail_refresh(client, monkeypatch):
+    raw = "NEWK-" + "-".join("".join(random.choices(string.ascii_uppercase, k=4)) for _ in range(3))
+    with models.SessionLocal() as db:
+        db.add(models.LicenseKey(key_hash=models.hash_license_key(raw), feature="pro"))
+        db.commit()
+    monkeypatch.setattr(license_filter, "_last_refresh", 0.0)
+    assert license_filter.might_exist(models.hash_license_key(raw))
+
+
+def test_late_commit_with_lower_id_is_not_missed():
+    models.init_db()
+    bf = LicenseKeyFilter(min_refresh_seconds=0)
+    bf.build()
+    with models.engine.connect() as conn:
+        top = conn.execute(select(func.max(models.LicenseKey.id))).scalar() or 0
+
+    def insert_key(key_id):
+        key_hash = h(f"late-{key_id}-{time.time()}")
+        with models.SessionLocal() as db:
+            db.add(models.LicenseKey(id=key_id, key_hash=key_hash, feature="pro"))
+            db.commit()
+        return key_hash
+
+    # 两个并发插入：id 较大的先提交并被增量拉取看到，id 较小的后提交
+    first = insert_key(top + 10)
+    assert bf.might_exist(first)
+    late = insert_key(top + 5)
+    assert bf.might_exist(late)
+
+    # 重复拉取不会重复计数
+    items = bf.snapshot()["items"]
+    bf.refresh_tail()
+    assert bf.snapshot()["items"] == items
+
+
+def test_burst_of_unknown_keys_refreshes_once(monkeypatch):
+    models.init_db()
+    bf = LicenseKeyFilter(min_refresh_seconds=60)
+    bf.build()
+    bf._last_refresh = 0.0
+    refresh_tail, calls = bf.refresh_tail, []
+
+    def slow_refresh(bind=None):
+        calls.append(1)
+        time.sleep(0.05)
+        return refresh_tail(bind)
+
+    monkeypatch.setattr(bf, "refresh_tail", slow_refresh)
+    threads = [threading.Thread(target=bf.might_exist, args=(h(f"unknown-{i}"),)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+
+
+def test_stats_are_exact_under_concurrent_checks():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    bf = LicenseKeyFilter()  # 未构建时全部放行
+    threads = [threading.Thread(target=lambda: [bf.might_exist("k") for _ in range(5000)]) for _ in range(8)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    stats = bf.snapshot()
+    assert stats["checks"] == stats["passed"] == 40_000
+
+
+def test_filter_stats_not_exposed(client, auth):
+    assert client.get("/license/filter-stats", headers=auth).status_code == 404
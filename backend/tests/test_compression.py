@@ -0,0 +1,87 @@
+import gzip
+import zlib
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from compression import CompressionMiddleware, negotiate
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size=500, route_levels={"/fast": 1})
+
+
+@app.get("/small")
+def small():
+    return {"ok": True}
+
+
+@app.get("/big")
+def big():
+    return {"items": ["description " * 20] * 50}
+
+
+@app.get("/fast")
+def fast():
+    return {"items": ["description " * 20] * 50}
+
+
+@app.get("/stream")
+def stream():
+    def rows():
+        for i in range(100):
+            yield f'{{"row": {i}, "text": "{"x" * 40}"}}\n'
+    return StreamingResponse(rows(), media_type="application/x-ndjson", headers={"ETag": '"7"'})
+
+
+client = TestClient(app)
+
+
+def raw_get(path, encoding="gzip"):
+    # 不让 httpx 自动解压，检查线上字节
+    with client.stream("GET", path, headers={"Accept-Encoding": encoding}) as r:
+        return r, b"".join(r.iter_raw())
+
+
+def test_negotiate_respects_q_values_and_server_preference():
+    assert negotiate("gzip, br", ["zstd", "br", "gzip"]) == "br"
+    assert negotiate("gzip;q=1.0, br;q=0.5", ["br", "gzip"]) == "gzip"
+    assert negotiate("gzip;q=0", ["gzip"]) is None
+    assert negotiate("*", ["br", "gzip"]) == "br"
+    assert negotiate("identity", ["gzip"]) is None
+
+
+def test_small_responses_are_not_compressed():
+    r, body = raw_get("/small")
+    assert "content-encoding" not in r.headers
+    assert body == b'{"ok":true}'
+
+
+def test_large_response_is_compressed():
+    r, body = raw_get("/big")
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.headers["vary"] == "Accept-Encoding"
+    assert int(r.headers["content-length"]) == len(body)
+    assert gzip.decompress(body) == client.get("/big", headers={"Accept-Encoding": "identity"}).content
+
+
+def test_route_level_is_applied():
+    _, default = raw_get("/big")
+    _, fast = raw_get("/fast")
+    assert gzip.decompress(fast) == gzip.decompress(default)
+    assert len(fast) >= len(default)
+
+
+def test_streaming_response_is_compressed_incrementally():
+    r, body = raw_get("/stream")
+    assert r.headers["content-encoding"] == "gzip"
+    assert "content-length" not in r.headers
+    assert r.headers["etag"] == 'W/"7"'
+    lines = gzip.decompress(body).decode().splitlines()
+    assert len(lines) == 100
+
+    # 每个压缩块以 sync flush 结尾，可以边收边解
+    with client.stream("GET", "/stream", headers={"Accept-Encoding": "gzip"}) as r:
+        d = zlib.decompressobj(31)
+        first = next(r.iter_raw())
+        assert d.decompress(first).startswith(b'{"row": 0')
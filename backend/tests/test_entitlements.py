@@ -0,0 +1,86 @@
+import time
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import delete
+
+import entitlements
+import models
+from models import EntitlementState, LicenseKey, User, UserLicense, utcnow
+
+
+@pytest.fixture
+def licensed_users():
+    models.init_db()
+    # 三个用户：已过期、即将过期、长期有效
+    now = utcnow()
+    expiries = [now - timedelta(minutes=5), now + timedelta(seconds=2), now + timedelta(days=30)]
+    ids = []
+    with models.SessionLocal() as db:
+        for i, expires_at in enumerate(expiries):
+            user = User(username=f"ent_{time.time_ns()}_{i}", email=f"ent_{time.time_ns()}_{i}@example.com", password_hash="x")
+            key = LicenseKey(key_hash=f"{time.time_ns():064d}"[-64:], is_used=True, feature="pro", expires_at=expires_at)
+            db.add_all([user, key])
+            db.flush()
+            db.add(UserLicense(user_id=user.id, license_key_id=key.id, feature="pro"))
+            db.add(EntitlementState(user_id=user.id, licensed=True, feature="pro", valid_until=expires_at))
+            ids.append(user.id)
+        db.commit()
+    yield ids
+    with models.engine.begin() as conn:
+        conn.execute(delete(EntitlementState).where(EntitlementState.user_id.in_(ids)))
+
+
+def licensed_flags(ids):
+    with models.SessionLocal() as db:
+        return [db.get(EntitlementState, uid).licensed for uid in ids]
+
+
+def test_sweep_revokes_only_expired(licensed_users):
+    entitlements.sweep_expired(batch_size=1)
+    assert licensed_flags(licensed_users) == [False, True, True]
+
+
+def test_sweeper_wakes_at_next_expiry(licensed_users):
+    sweeper = entitlements.EntitlementSweeper(max_sleep=60)
+    sweeper.start()
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline and licensed_flags(licensed_users)[1]:
+            time.sleep(0.1)
+    finally:
+        sweeper.stop()
+    assert licensed_flags(licensed_users) == [False, False, True]
+    assert sweeper.sweeps >= 2
+
+
+def test_rebuild_matches_latest_activation(licensed_users):
+    entitlements.rebuild_entitlements(batch_size=2)
+    assert licensed_flags(licensed_users) == [False, True, True]
+
+
+def test_concurrent_first_activation_upserts():
+    models.init_db()
+    with models.SessionLocal() as db:
+        user = User(username=f"ent_race_{time.time_ns()}", email=f"ent_race_{time.time_ns()}@example.com", password_hash="x")
+        db.add(user)
+        db.commit()
+        uid = user.id
+    expires_at = (utcnow() + timedelta(days=1)).replace(microsecond=0)
+    # 两个请求都在对方提交前读到“无授权状态”
+    first, second = models.SessionLocal(), models.SessionLocal()
+    try:
+        assert first.get(EntitlementState, uid) is None
+        assert second.get(EntitlementState, uid) is None
+        entitlements.record_activation(first, uid, "basic", None)
+        first.commit()
+        entitlements.record_activation(second, uid, "pro", expires_at)
+        second.commit()
+    finally:
+        first.close()
+        second.close()
+    with models.SessionLocal() as db:
+        ent = db.get(EntitlementState, uid)
+        assert (ent.licensed, ent.feature, ent.valid_until) == (True, "pro", expires_at)
+        db.delete(ent)
+        db.commit()
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+
+import models
+from conftest import rand_str
+from idempotency import IdempotencyStore, fingerprint
+
+
+def test_retried_create_is_replayed(client, auth):
+    key = {"Idempotency-Key": rand_str("k")}
+    first = client.post("/api/v1/tasks", headers={**auth, **key}, json={"title": "once"})
+    again = client.post("/api/v1/tasks", headers={**auth, **key}, json={"title": "once"})
+    assert first.status_code == again.status_code == 201
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert again.json() == first.json()
+
+    listed = client.get("/api/v1/tasks", headers=auth).json()
+    assert listed["count"] == 1
+
+    # 同一个键换了请求内容
+    r = client.post("/api/v1/tasks", headers={**auth, **key}, json={"title": "other"})
+    assert r.status_code == 422
+
+
+def test_concurrent_duplicates_execute_once():
+    store = IdempotencyStore(use_db=False)
+    calls = []
+
+    def execute():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"id": len(calls)}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(store.run(1, "t", "k", {"a": 1}, execute)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results.count({"id": 1}) == 1
+    assert sum(1 for r in results if getattr(r, "status_code", None) == 200) == 4
+
+
+def test_waiting_duplicate_releases_its_connection():
+    store = IdempotencyStore(use_db=False)
+    running, finish = threading.Event(), threading.Event()
+
+    def execute():
+        running.set()
+        finish.wait(5)
+        return {"n": 1}
+
+    first = threading.Thread(target=lambda: store.run(1, "t", "k", {}, execute))
+    first.start()
+    running.wait(5)
+    db = models.SessionLocal()
+    db.execute(select(1))  # 鉴权查询已打开事务
+    assert db.in_transaction()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(store.run(1, "t", "k", {}, execute, db=db)))
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while store.stats["waited"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # 等待期间不持有事务与连接
+    assert not db.in_transaction()
+    finish.set()
+    first.join()
+    waiter.join()
+    db.close()
+    assert results[0].status_code == 200
+
+
+def test_failed_execution_releases_key():
+    store = IdempotencyStore(use_db=False)
+
+    def fail():
+        raise HTTPException(status_code=500, detail="boom")
+
+    with pytest.raises(HTTPException):
+        store.run(1, "t", "k", {}, fail)
+    assert store.run(1, "t", "k", {}, lambda: {"ok": True}) == {"ok": True}
+
+
+def test_db_store_is_shared_between_processes():
+    models.init_db()
+    key = rand_str("k")
+    first = IdempotencyStore(use_db=True)
+    second = IdempotencyStore(use_db=True)  # 模拟另一个 worker（进程内缓存为空）
+    assert first.run(7, "t", key, {"a": 1}, lambda: {"n": 1}) == {"n": 1}
+
+    def must_not_run():
+        raise AssertionError("executed twice")
+
+    replay = second.run(7, "t", key, {"a": 1}, must_not_run)
+    assert replay.status_code == 200
+    assert replay.body == b'{"n":1}'
+
+
+def test_db_placeholder_outlives_wait_time():
+    models.init_db()
+    key = (7, "t", rand_str("k"))
+    slow = IdempotencyStore(use_db=True, wait_seconds=0.1, lease_seconds=60)
+    other = IdempotencyStore(use_db=True, wait_seconds=0.1, lease_seconds=60)
+    saved, owner = slow._db_acquire(key, fingerprint({}), time.monotonic() + 1)
+    assert saved is None and owner
+
+    # 首个请求仍在执行（远超等待时间）：其他 worker 等待超时后返回 409，而不是再执行一次
+    time.sleep(0.2)
+    with pytest.raises(HTTPException) as exc:
+        other.run(*key, {}, lambda: pytest.fail("executed twice"))
+    assert exc.value.status_code == 409
+    assert exc.value.headers["Retry-After"] == "1"
+    slow._db_release(key, {"status": 200, "body": {"n": 1}, "headers": {}}, owner)
+    assert other.run(*key, {}, lambda: pytest.fail("executed twice")).body == b'{"n":1}'
+
+
+def test_expired_lease_does_not_overwrite_new_owner():
+    models.init_db()
+    key = (7, "t", rand_str("k"))
+    crashed = IdempotencyStore(use_db=True, lease_seconds=0)
+    _, stale_owner = crashed._db_acquire(key, fingerprint({}), time.monotonic() + 1)
+
+    # 租约过期后由其他 worker 接管并完成
+    second = IdempotencyStore(use_db=True)
+    assert second.run(*key, {}, lambda: {"n": 2}) == {"n": 2}
+
+    # 原持有者迟到的释放与写入都不生效
+    crashed._db_release(key, None, stale_owner)
+    crashed._db_release(key, {"status": 200, "body": {"n": 1}, "headers": {}}, stale_owner)
+    replay = IdempotencyStore(use_db=True).run(*key, {}, lambda: pytest.fail("executed twice"))
+    assert replay.body == b'{"n":2}'
@@ -0,0 +1,43 @@
+import time
+
+from conftest import rand_str
+from leader import JobLeader
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_only_one_process_runs_jobs_and_another_takes_over():
+    name = rand_str("jobs-")
+    running = []
+
+    def leader(tag):
+        return JobLeader(lambda: running.append(tag), lambda: running.remove(tag), name=name, retry_seconds=0.05)
+
+    # 模拟两个 worker 进程
+    first, second = leader("a"), leader("b")
+    first.start()
+    assert wait_for(lambda: first.leading)
+    second.start()
+    time.sleep(0.2)
+    assert running == ["a"] and not second.leading
+
+    # 持锁进程退出后，另一个进程在下一次重试时接管
+    first.stop()
+    assert wait_for(lambda: second.leading)
+    assert running == ["b"]
+    second.stop()
+    assert running == []
+
+
+def test_disabled_process_never_runs_jobs():
+    calls = []
+    leader = JobLeader(lambda: calls.append(1), lambda: None, name=rand_str("jobs-"), enabled=False)
+    leader.start()
+    time.sleep(0.1)
+    leader.stop()
+    assert calls == [] and not leader.leading
@@ -0,0 +1,83 @@
+import os
+import random
+import string
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+import models
+import profiling
+from bloom import license_filter
+from conftest import PASSWORD, rand_str, register
+
+
+@pytest.fixture
+def raise_mode(monkeypatch):
+    monkeypatch.setattr(profiling, "SQL_CHECKS", "raise")
+
+
+def login(client):
+    username = rand_str("user_")
+    r = register(client, username)
+    assert r.status_code == 200, r.text
+    r = client.post("/auth/login", json={"username": username, "password": PASSWORD})
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+def test_lazy_load_and_n_plus_one_are_flagged(raise_mode):
+    models.init_db()
+    with models.SessionLocal() as db:
+        user = models.User(username=rand_str(), email=f"{rand_str()}@example.com", password_hash="x", status=1)
+        db.add(user)
+        db.commit()
+        with pytest.raises(profiling.QueryCheckError, match="lazy load of User.tasks"):
+            with profiling.track_queries():
+                db.get(models.User, user.id, populate_existing=True).tasks
+
+    with models.SessionLocal() as db:
+        with pytest.raises(profiling.QueryCheckError, match="duplicate statement"):
+            with profiling.track_queries():
+                for _ in range(2):
+                    db.execute(select(models.User.id).where(models.User.id == 1)).all()
+
+
+def test_api_has_no_lazy_loads_or_repeated_queries(client, raise_mode):
+    # raise 模式下把常用接口走一遍：出现懒加载或重复语句时请求直接报错
+    headers = login(client)
+    t = client.post("/api/v1/tasks", headers=headers, json={"title": "p", "column": "To Do"}).json()["data"]
+    assert client.get("/api/v1/tasks", headers=headers).status_code == 200
+    assert client.get(f"/api/v1/tasks/{t['id']}", headers=headers).status_code == 200
+    assert client.patch(f"/api/v1/tasks/{t['id']}", headers=headers, json={"title": "q"}).status_code == 200
+    assert client.patch(f"/api/v1/tasks/{t['id']}/move", headers=headers, json={"column": "Doing"}).status_code == 200
+    assert client.patch(f"/api/v1/tasks/{t['id']}/toggle", headers=headers).status_code == 200
+    assert client.get("/api/v1/tasks/stats", headers=headers).status_code == 200
+    assert client.delete(f"/api/v1/tasks/{t['id']}", headers=headers).status_code == 200
+
+    raw = "PROF-ILES-" + "".join(random.choices(string.ascii_uppercase, k=4)) + "-1234"
+    with models.SessionLocal() as db:
+        db.add(models.LicenseKey(key_hash=models.hash_license_key(raw), feature="pro",
+                                 expires_at=datetime.utcnow() + timedelta(days=30)))
+        db.commit()
+    license_filter.add(models.hash_license_key(raw))
+    assert client.post("/license/activate", headers=headers, json={"key": raw}).status_code == 200
+    assert client.get("/license/status", headers=headers).json()["licensed"] is True
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+
+def test_profile_header_writes_folded_stacks(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    headers = login(client)
+
+    r = client.get("/api/v1/tasks", headers=headers)
+    assert "x-profile-id" not in r.headers
+
+    r = client.get("/api/v1/tasks", headers={**headers, "X-Profile": "wrong"})
+    assert "x-profile-id" not in r.headers
+
+    r = client.get("/api/v1/tasks", headers={**headers, "X-Profile": "secret"})
+    profile_id = r.headers["x-profile-id"]
+    assert "db;dur=" in r.headers["server-timing"]
+    assert os.path.exists(tmp_path / f"{profile_id}.folded")
@@ -0,0 +1,159 @@
+import random
+import string
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+import models
+from bloom import license_filter
+from conftest import PASSWORD, rand_str, register
+from profiling import BACKGROUND_THREADS
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        # 后台线程（过滤器构建、事件写入、清扫、归档）的查询不计入请求
+        if threading.current_thread().name not in BACKGROUND_THREADS:
+            statements.append(statement)
+
+    event.listen(models.engine, "before_cursor_execute", _before)
+    try:
+        yield statements
+    finally:
+        event.remove(models.engine, "before_cursor_execute", _before)
+
+
+def create_task(client, auth, column="To Do"):
+    r = client.post("/api/v1/tasks", headers=auth, json={"title": "T " + rand_str(), "column": column})
+    assert r.status_code == 201, r.text
+    return r.json()["data"]
+
+
+def test_create_task_single_insert(client, auth):
+    # 鉴权 1 次 + INSERT 1 次（不再 refresh）+ 同一事务内的列计数 upsert 1 次
+    with count_queries() as q:
+        t = create_task(client, auth)
+    assert len(q) == 3, q
+    assert t["createdAt"] and t["updatedAt"] and t["version"] == 1
+
+
+@pytest.mark.parametrize("method,suffix,body,stage_upsert", [
+    ("patch", "", {"title": "Renamed"}, 0),
+    ("patch", "/move", {"column": "Doing"}, 1),
+    ("patch", "/toggle", None, 1),
+    ("delete", "", None, 1),
+])
+def test_task_mutation_statement_count(client, auth, method, suffix, body, stage_upsert):
+    t = create_task(client, auth)
+    with count_queries() as q:
+        r = client.request(method.upper(), f"/api/v1/tasks/{t['id']}{suffix}", headers=auth, json=body)
+    assert r.status_code == 200, r.text
+    # 鉴权 1 次 + 写入 1 次（SQLite 支持 RETURNING，无需回查）；换列/删除在同一事务内
+    # 另有 1 次列计数 upsert（task_stage_counts 与任务写入保持一致）
+    assert len(q) == 2 + stage_upsert, q
+
+
+def test_activate_license_no_refresh(client, auth):
+    raw = "ABCD-EFGH-" + "".join(random.choices(string.ascii_uppercase, k=4)) + "-1234"
+    with models.SessionLocal() as db:
+        db.add(models.LicenseKey(
+            key_hash=models.hash_license_key(raw),
+            feature="pro",
+            expires_at=datetime.utcnow() + timedelta(days=30),
+        ))
+        db.commit()
+    # 直接加入布隆过滤器，避免增量拉取的查询计入本请求（generate_license.py 生成的密钥靠增量拉取发现）
+    license_filter.add(models.hash_license_key(raw))
+
+    with count_queries() as q:
+        r = client.post("/license/activate", headers=auth, json={"key": raw})
+    assert r.status_code == 200, r.text
+    assert r.json()["licensed"] is True
+    # 鉴权 + 授权状态主键读取 + 密钥查询 + 更新密钥 + 插入激活记录 + 写入授权状态
+    assert len(q) == 6, q
+
+    with count_queries() as q:
+        r = client.get("/license/status", headers=auth)
+    assert r.json()["licensed"] is True
+    # 鉴权 + 授权状态主键读取
+    assert len(q) == 2, q
+
+
+def test_register_inserts_without_precheck(client):
+    username = rand_str("user_")
+    with count_queries() as q:
+        r = register(client, username)
+    assert r.status_code == 200, r.text
+    assert not any(s.lstrip().upper().startswith("SELECT") for s in q), q
+
+    # 重复由唯一索引判出，错误信息与原来一致
+    r = register(client, username, f"{rand_str()}@example.com")
+    assert r.status_code == 400 and r.json()["detail"] == "Username already taken"
+    r = register(client, rand_str("user_"), f"{username}@example.com")
+    assert r.status_code == 400 and r.json()["detail"] == "Email already registered"
+
+
+@pytest.mark.parametrize("message", [
+    "(1062, \"Duplicate entry 'emailfan' for key 'users.ix_users_username'\")",
+    "UNIQUE constraint failed: users.username",
+])
+def test_duplicate_username_containing_email(client, message):
+    from sqlalchemy.exc import IntegrityError
+    from routers.auth import _violates_email_unique
+
+    # 用户名里含 "email" 不能被当作邮箱冲突（MySQL 消息带有重复值本身）
+    assert not _violates_email_unique(IntegrityError("INSERT", {}, Exception(message)))
+
+    username = rand_str("emailfan_")
+    assert register(client, username).status_code == 200
+    r = register(client, username, f"{rand_str()}@example.com")
+    assert r.status_code == 400 and r.json()["detail"] == "Username already taken"
+
+
+def test_login_after_registration_in_another_worker(client):
+    from routers.auth import hash_password
+
+    username = rand_str("late_")
+    body = {"username": username, "password": PASSWORD}
+    assert client.post("/auth/login", json=body).status_code == 401
+    # 其他 worker 处理注册：本进程的计数不会被清理
+    with models.SessionLocal() as db:
+        db.add(models.User(username=username, email=f"{username}@example.com", password_hash=hash_password(PASSWORD)))
+        db.commit()
+    assert client.post("/auth/login", json=body).status_code == 200
+
+
+def test_login_single_indexed_lookup(client):
+    username = rand_str("user_")
+    register(client, username)
+    for identifier in (username, f"{username}@example.com"):
+        with count_queries() as q:
+            r = client.post("/auth/login", json={"username": identifier, "password": PASSWORD})
+        assert r.status_code == 200, r.text
+        assert len(q) == 1, q
+        assert " OR " not in q[0].upper()
+
+
+def test_unknown_login_is_rate_limited(client):
+    from routers.auth import LOGIN_UNKNOWN_MAX_ATTEMPTS
+
+    username = rand_str("ghost_")
+    body = {"username": username, "password": PASSWORD}
+    with count_queries() as q:
+        for _ in range(LOGIN_UNKNOWN_MAX_ATTEMPTS):
+            assert client.post("/auth/login", json=body).status_code == 401
+    assert len(q) == LOGIN_UNKNOWN_MAX_ATTEMPTS, q
+    # 超限后直接返回 429，不查库
+    with count_queries() as q:
+        assert client.post("/auth/login", json=body).status_code == 429
+    assert len(q) == 0, q
+
+    # 注册后立即可以登录
+    assert register(client, username).status_code == 200
+    assert client.post("/auth/login", json=body).status_code == 200
@@ -0,0 +1,92 @@
+import sqlite3
+import time
+
+import pytest
+from sqlalchemy import event
+
+import models
+from conftest import auth_headers
+
+
+def sqlite_path(engine) -> str:
+    return engine.url.database
+
+
+def replicate(primary, replica):
+    # 模拟副本追上主库：整库复制
+    src = sqlite3.connect(sqlite_path(primary))
+    dst = sqlite3.connect(sqlite_path(replica))
+    with dst:
+        src.backup(dst)
+    src.close()
+    dst.close()
+    replica.dispose()
+
+
+@pytest.fixture
+def replica(monkeypatch, tmp_path):
+    replica_engine = models.make_engine(f"sqlite:///{tmp_path}/replica.db")
+    models.Base.metadata.create_all(bind=replica_engine)
+    monkeypatch.setattr(models, "replica_engines", [replica_engine])
+    yield replica_engine
+    replica_engine.dispose()
+
+
+def counter(engine):
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+    return statements
+
+
+def test_reads_follow_writes_then_go_to_replica(client, replica, monkeypatch):
+    headers = auth_headers(client)
+
+    r = client.post("/api/v1/tasks", headers=headers, json={"title": "sticky"})
+    assert r.status_code == 201, r.text
+
+    # 写后窗口内：读请求走主库，能看到自己的写入（副本尚未同步）
+    on_replica = counter(replica)
+    r = client.get("/api/v1/tasks", headers=headers)
+    assert r.status_code == 200 and r.json()["count"] == 1
+    r = client.get("/users/me", headers=headers)
+    assert r.status_code == 200
+    assert on_replica == []
+
+    # 下一个请求落到另一个 worker（进程内记录为空）：客户端带回的 cookie 仍固定走主库
+    monkeypatch.setattr(models, "_recent_writers", {})
+    assert models.READ_YOUR_WRITES_COOKIE in client.cookies
+    r = client.get("/users/me", headers=headers)
+    assert r.status_code == 200
+    assert on_replica == []
+
+    # 窗口过期（cookie 失效）：读请求发往滞后的副本，看不到新用户
+    client.cookies.clear()
+    r = client.get("/users/me", headers=headers)
+    assert r.status_code == 401
+    assert on_replica
+
+    # 副本追上后，读请求完全由副本服务
+    replicate(models.engine, replica)
+    on_primary = counter(models.engine)
+    r = client.get("/api/v1/tasks", headers=headers)
+    assert r.status_code == 200 and r.json()["count"] == 1
+    assert on_primary == []
+
+
+def test_writes_stay_on_primary(client, replica):
+    headers = auth_headers(client)
+    on_replica = counter(replica)
+    r = client.post("/api/v1/tasks", headers=headers, json={"title": "primary only"})
+    assert r.status_code == 201, r.text
+    assert on_replica == []
+
+
+def test_forged_pin_is_ignored(client, replica, monkeypatch):
+    headers = auth_headers(client)
+    monkeypatch.setattr(models, "_recent_writers", {})
+    # 远超窗口上限的截止时间不被接受，读请求照常发往副本
+    client.cookies.set(models.READ_YOUR_WRITES_COOKIE, str(time.time() + 3600))
+    on_replica = counter(replica)
+    assert client.get("/users/me", headers=headers).status_code == 401
+    assert on_replica
+    client.cookies.clear()
@@ -0,0 +1,79 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import delete
+
+import main
+import models
+import rollups
+from activity import ActivityLog
+from conftest import auth_headers
+
+
+def stats(headers):
+    with TestClient(main.app) as client:
+        r = client.get("/api/v1/tasks/stats", headers=headers, params={"days": 7})
+    assert r.status_code == 200, r.text
+    return r.json()["data"]
+
+
+def test_stats_follow_mutations_and_match_rebuild():
+    # 退出 TestClient 时写入线程排空队列，汇总随之更新
+    with TestClient(main.app) as client:
+        headers = auth_headers(client)
+        ids = [
+            client.post("/api/v1/tasks", headers=headers, json={"title": f"s{i}", "column": col}).json()["data"]["id"]
+            for i, col in enumerate(["To Do", "To Do", "Doing", "Done"])
+        ]
+        client.patch(f"/api/v1/tasks/{ids[0]}/move", headers=headers, json={"column": "Doing"})
+        client.patch(f"/api/v1/tasks/{ids[2]}/move", headers=headers, json={"column": "Done"})
+        client.patch(f"/api/v1/tasks/{ids[1]}", headers=headers, json={"title": "renamed"})
+        client.patch(f"/api/v1/tasks/{ids[3]}/toggle", headers=headers)
+        client.delete(f"/api/v1/tasks/{ids[1]}", headers=headers)
+
+    data = stats(headers)
+    assert data["columns"] == {"To Do": 1, "Doing": 1, "Done": 1}
+    assert len(data["daily"]) == 1
+    assert data["daily"][0]["created"] == 4
+    assert data["daily"][0]["completed"] == 2
+    assert data["avgDoingSeconds"] is not None
+
+    rollups.rebuild(models.engine)
+    assert stats(headers) == data
+
+
+def test_stage_counts_are_updated_in_the_request_transaction():
+    with TestClient(main.app) as client:
+        headers = auth_headers(client)
+        t = client.post("/api/v1/tasks", headers=headers, json={"title": "now"}).json()["data"]
+        client.patch(f"/api/v1/tasks/{t['id']}/move", headers=headers, json={"column": "Doing"})
+        # 不等写入线程：列计数已随任务写入提交
+        r = client.get("/api/v1/tasks/stats", headers=headers)
+        assert r.json()["data"]["columns"] == {"To Do": 0, "Doing": 1, "Done": 0}
+
+        # 版本冲突的写入整体回滚，计数不变
+        r = client.patch(f"/api/v1/tasks/{t['id']}/move", headers=headers, json={"column": "Done", "version": 1})
+        assert r.status_code == 409
+        client.delete(f"/api/v1/tasks/{t['id']}", headers=headers)
+        r = client.get("/api/v1/tasks/stats", headers=headers)
+        assert r.json()["data"]["columns"] == {"To Do": 0, "Doing": 0, "Done": 0}
+
+
+def test_dropped_events_trigger_daily_rebuild():
+    with TestClient(main.app) as client:
+        headers = auth_headers(client)
+        for i in range(2):
+            client.post("/api/v1/tasks", headers=headers, json={"title": f"d{i}", "column": "Done"})
+        user_id = client.get("/users/me", headers=headers).json()["id"]
+    expected = stats(headers)
+    assert expected["daily"][0]["created"] == 2
+
+    # 模拟按天统计的更新丢失，随后又有事件因队列满被丢弃
+    with models.engine.begin() as conn:
+        conn.execute(delete(models.TaskDailyStat).where(models.TaskDailyStat.user_id == user_id))
+    log = ActivityLog(maxsize=1)
+    log.record(user_id, 1, "updated")
+    log.record(user_id, 2, "updated")
+    assert log.stats["dropped"] == 1
+
+    log.repair()
+    assert log.stats["repairs"] == 1
+    assert stats(headers) == expected
@@ -0,0 +1,74 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import inspect, select
+
+import main
+import models
+from conftest import auth_headers
+
+
+@pytest.fixture
+def shards(monkeypatch, tmp_path):
+    engines = [models.make_engine(f"sqlite:///{tmp_path}/shard{i}.db") for i in range(3)]
+    monkeypatch.setattr(models, "shard_engines", engines)
+    models.init_db()
+    yield engines
+    for e in engines:
+        e.dispose()
+
+
+@pytest.fixture
+def client(shards):
+    with TestClient(main.app) as c:
+        yield c
+
+
+def register(client):
+    headers = auth_headers(client)
+    user_id = client.get("/users/me", headers=headers).json()["id"]
+    return user_id, headers
+
+
+def task_owners(engine):
+    with engine.connect() as conn:
+        return set(conn.execute(select(models.Task.user_id)).scalars())
+
+
+def test_tasks_land_on_owner_shard(client, shards):
+    users = [register(client) for _ in range(6)]
+    for user_id, headers in users:
+        for i in range(2):
+            r = client.post("/api/v1/tasks", headers=headers, json={"title": f"task {i}"})
+            assert r.status_code == 201, r.text
+
+    for index, engine in enumerate(shards):
+        owners = task_owners(engine)
+        assert all(uid % len(shards) == index for uid in owners)
+    # 目录库不保存分片表数据
+    assert not task_owners(models.engine) & {uid for uid, _ in users}
+
+    for user_id, headers in users:
+        r = client.get("/api/v1/tasks", headers=headers)
+        assert r.json()["count"] == 2
+
+
+def test_task_mutations_resolve_shard(client, shards):
+    user_id, headers = register(client)
+    t = client.post("/api/v1/tasks", headers=headers, json={"title": "move me"}).json()["data"]
+    r = client.patch(f"/api/v1/tasks/{t['id']}/move", headers=headers, json={"column": "Done"})
+    assert r.status_code == 200 and r.json()["data"]["completed"] is True
+    r = client.delete(f"/api/v1/tasks/{t['id']}", headers=headers)
+    assert r.status_code == 200
+    assert not task_owners(shards[user_id % len(shards)]) & {user_id}
+
+
+def test_users_stay_in_catalog(client, shards):
+    user_id, headers = register(client)
+    r = client.post("/api/v1/tasks", headers=headers, json={"title": "no parent row"})
+    assert r.status_code == 201, r.text
+    # 分片只有分片表：不保存用户行（凭据），任务表也没有指向 users 的外键
+    home = shards[user_id % len(shards)]
+    insp = inspect(home)
+    assert not insp.has_table("users")
+    assert set(insp.get_table_names()) == models.SHARDED_TABLES
+    assert insp.get_foreign_keys("tasks") == []
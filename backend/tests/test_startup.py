@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 这些模块只应在第一次使用时导入（见 routers/auth.py 与 models.make_engine）
+DEFERRED = ["passlib", "bcrypt", "jose", "jwt", "MySQLdb", "pymysql"]
+
+
+def test_import_main_defers_heavy_modules():
+    code = (
+        "import sys, main\n"
+        f"print(','.join(m for m in {DEFERRED!r} if m in sys.modules))"
+    )
+    env = dict(os.environ, DATABASE_URL="mysql+pymysql://u:p@127.0.0.1:1/db")
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=BACKEND, env=env, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    assert out == ""
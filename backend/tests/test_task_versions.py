@@ -0,0 +1,90 @@
+import pytest
+
+
+def create_task(client, auth):
+    r = client.post("/api/v1/tasks", headers=auth, json={"title": "versioned"})
+    assert r.status_code == 201, r.text
+    assert r.headers["ETag"] == '"1"'
+    return r.json()["data"]
+
+
+def error_code(r):
+    return r.json()["detail"]["error"]["code"]
+
+
+@pytest.mark.parametrize("method,suffix,body", [
+    ("PATCH", "", {"title": "Renamed"}),
+    ("PATCH", "", {"completed": True}),
+    ("PATCH", "/move", {"column": "Doing"}),
+    ("PATCH", "/toggle", None),
+])
+def test_each_mutation_bumps_version(client, auth, method, suffix, body):
+    t = create_task(client, auth)
+    for expected in (2, 3):
+        r = client.request(method, f"/api/v1/tasks/{t['id']}{suffix}", headers=auth, json=body)
+        assert r.status_code == 200, r.text
+        assert r.json()["data"]["version"] == expected
+        assert r.headers["ETag"] == f'"{expected}"'
+    r = client.get(f"/api/v1/tasks/{t['id']}", headers=auth)
+    assert r.headers["ETag"] == '"3"'
+
+
+def test_stale_if_match_is_412(client, auth):
+    t = create_task(client, auth)
+    url = f"/api/v1/tasks/{t['id']}"
+    assert client.patch(url, headers={**auth, "If-Match": '"1"'}, json={"title": "first"}).status_code == 200
+
+    r = client.patch(url, headers={**auth, "If-Match": '"1"'}, json={"title": "second"})
+    assert r.status_code == 412
+    assert error_code(r) == "PRECONDITION_FAILED"
+    assert r.json()["detail"]["error"]["details"] == {"version": 2}
+    # 失败的写入不生效
+    assert client.get(url, headers=auth).json()["data"]["title"] == "first"
+
+
+def test_stale_body_version_is_409(client, auth):
+    t = create_task(client, auth)
+    url = f"/api/v1/tasks/{t['id']}/move"
+    assert client.patch(url, headers=auth, json={"column": "Doing", "version": 1}).status_code == 200
+
+    r = client.patch(url, headers=auth, json={"column": "Done", "version": 1})
+    assert r.status_code == 409
+    assert error_code(r) == "VERSION_CONFLICT"
+    assert r.json()["detail"]["error"]["details"] == {"version": 2}
+
+
+@pytest.mark.parametrize("if_match", ["*", 'W/"1"', "1"])
+def test_if_match_forms(client, auth, if_match):
+    t = create_task(client, auth)
+    r = client.patch(f"/api/v1/tasks/{t['id']}", headers={**auth, "If-Match": if_match}, json={"title": "ok"})
+    assert r.status_code == 200, r.text
+    assert r.json()["data"]["version"] == 2
+
+
+def test_invalid_if_match_is_400(client, auth):
+    t = create_task(client, auth)
+    r = client.patch(f"/api/v1/tasks/{t['id']}", headers={**auth, "If-Match": '"abc"'}, json={"title": "x"})
+    assert r.status_code == 400
+    assert r.json()["detail"]["error"]["details"] == {"If-Match": "Invalid ETag"}
+
+
+def test_delete_with_if_match(client, auth):
+    t = create_task(client, auth)
+    url = f"/api/v1/tasks/{t['id']}"
+    client.patch(url, headers=auth, json={"title": "v2"})
+
+    r = client.delete(url, headers={**auth, "If-Match": '"1"'})
+    assert r.status_code == 412
+    assert client.get(url, headers=auth).status_code == 200
+
+    assert client.delete(url, headers={**auth, "If-Match": 'W/"2"'}).status_code == 200
+    assert client.get(url, headers=auth).status_code == 404
+
+
+def test_missing_task_is_404_regardless_of_precondition(client, auth):
+    other = create_task(client, auth)
+    client.delete(f"/api/v1/tasks/{other['id']}", headers=auth)
+    for method, suffix, body in [("PATCH", "", {"title": "x"}), ("PATCH", "/toggle", None), ("DELETE", "", None)]:
+        r = client.request(method, f"/api/v1/tasks/{other['id']}{suffix}", headers={**auth, "If-Match": '"1"'}, json=body)
+        assert r.status_code == 404
+        assert error_code(r) == "TASK_NOT_FOUND"
@@ -0,0 +1,40 @@
+import time
+
+from routers import auth
+
+
+def test_cache_hit_skips_decode(monkeypatch):
+    auth.token_cache.clear()
+    token = auth.create_access_token(42)
+    calls = []
+    real_decode = auth._jwt_decode
+    monkeypatch.setattr(auth, "_jwt_decode", lambda t: calls.append(t) or real_decode(t))
+
+    first = auth.decode_token(token)
+    second = auth.decode_token(token)
+    assert first["sub"] == second["sub"] == "42"
+    assert len(calls) == 1
+
+
+def test_cache_respects_exp():
+    cache = auth.TokenCache(maxsize=10, ttl=3600)
+    cache.put("expired", {"sub": "1", "exp": int(time.time()) - 1})
+    cache.put("valid", {"sub": "2", "exp": int(time.time()) + 60})
+    assert cache.get("expired") is None
+    assert cache.get("valid")["sub"] == "2"
+
+
+def test_cache_is_bounded_lru():
+    cache = auth.TokenCache(maxsize=2, ttl=3600)
+    cache.put("a", {"sub": "a"})
+    cache.put("b", {"sub": "b"})
+    cache.get("a")
+    cache.put("c", {"sub": "c"})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_invalid_token_not_cached():
+    auth.token_cache.clear()
+    assert auth.decode_token("not-a-jwt") is None
+    assert auth.token_cache.get("not-a-jwt") is None